@@ -40,6 +40,7 @@ import asyncio
 import argparse
 import logging
 from functools import wraps
+from collections import Counter
 import toml
 import aiohttp
 
@@ -118,6 +119,11 @@ class Miner(Lotus):
     Error = MinerError
     miner_id = None
 
+    # Sector file types (bits of SectorFileType) and their name in the storage URLs
+    file_types = {1: "unsealed", 2: "sealed", 4: "cache", 8: "update", 16: "update-cache"}
+    # Size on the disk of the sector file types, in sector sizes. The size of the cache files depends on the proof, it is unknown
+    file_sizes = {1: 1, 2: 1, 8: 1}
+
     @Error.wrap
     def id(self):
         """ return miner ID"""
@@ -126,6 +132,27 @@ class Miner(Lotus):
             self.miner_id = actoraddress['result']
         return self.miner_id
 
+    @Error.wrap
+    def sector_size(self):
+        """ return the sector size of the miner in bytes"""
+        return int(self.get("ActorSectorSize", [self.id()])["result"])
+
+    @Error.wrap
+    def get_sector_locations(self, file_types):
+        """ Index the sector files of the miner declared in the storages with one StorageList call :
+        {(sector number, file type): storage id}. A file declared in several storages is indexed to None"""
+        miner_num = int(self.id()[2:])
+        locations = {}
+        for storage_id, declarations in self.get("StorageList", [])["result"].items():
+            for declaration in declarations:
+                if declaration["Miner"] != miner_num:
+                    continue
+                for file_type in file_types:
+                    if declaration["SectorFileType"] & file_type:
+                        key = (declaration["Number"], file_type)
+                        locations[key] = None if key in locations else storage_id
+        return locations
+
     @Error.wrap
     def get_storagelist_enhanced(self):
         """ Get storage list enhanced with reverse hostname lookup"""
@@ -168,6 +195,65 @@ class Miner(Lotus):
             res.append(sto)
         return res
 
+class SectorLocations():
+    """ Storage of the sector files of the miner : {(sector number, file type): storage id}. Sector placement rarely
+    changes, the locations are kept in a file between the runs and only the new sectors and the sectors of the sealing
+    jobs (finalize, move to storage...) are resolved again. All the locations are retrieved again with StorageList
+    every max_age seconds"""
+
+    # Above this number of sectors to resolve, all the locations are retrieved with StorageList
+    resolve_limit = 1000
+
+    def __init__(self, miner_id, index=None, refreshed=0, pending=()):
+        self.miner_id = miner_id
+        self.index = index or {}
+        self.refreshed = refreshed
+        self.pending = set(pending)
+
+    @classmethod
+    def load(cls, path, miner_id):
+        """ return the locations stored in path, None if there are none for this miner. A file that can't be read or doesn't
+        have the expected structure is ignored : all the locations are retrieved again"""
+        try:
+            with open(path, encoding="utf-8") as data_file:
+                data = json.load(data_file)
+            if data.get("miner_id") != miner_id:
+                return None
+
+            # locations are stored as {file type: {storage id: [sector numbers]}}
+            index = {}
+            for file_type, storages in data["locations"].items():
+                for storage_id, sectors in storages.items():
+                    for sector in sectors:
+                        index[(cls.sector_number(sector), int(file_type))] = storage_id
+            return cls(miner_id, index, float(data["refreshed"]), [cls.sector_number(sector) for sector in data["pending"]])
+        except FileNotFoundError:
+            return None
+        except Exception as exp:
+            logging.warning(f"ignoring sector locations file {path} : {exp}")
+            return None
+
+    @staticmethod
+    def sector_number(value):
+        """ return value if it is a sector number, raise an exception otherwise"""
+        if value.__class__ is not int or value < 0:
+            raise ValueError(f"invalid sector number {value!r}")
+        return value
+
+    def save(self, path, sectors):
+        """ store the locations of the sectors in path"""
+        locations = {}
+        for (sector, file_type), storage_id in self.index.items():
+            if sector in sectors and storage_id is not None:
+                locations.setdefault(str(file_type), {}).setdefault(storage_id, []).append(sector)
+        tmp_file = f"{path}$$"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as data_file:
+                json.dump({"miner_id": self.miner_id, "refreshed": self.refreshed, "pending": sorted(self.pending), "locations": locations}, data_file)
+            os.rename(tmp_file, path)
+        except Exception as exp:
+            logging.warning(f"cannot write sector locations file {path} : {exp}")
+
 class Metrics():
     """ This class manage prometheus metrics formatting / checking / print """
 
@@ -178,16 +264,24 @@ class Metrics():
     __METRICS_LIST = {
         "scrape_duration_seconds"                   : {"type" : "gauge", "help": "execution time of the different collectors"},
         "scrape_execution_succeed"                  : {"type" : "gauge", "help": "return 1 if lotus-farcaster-green execution was successfully"},
-        "sector_resource"                     : {"type" : "gauge", "help": "resource consummed by the sector"}
+        "sector_resource"                     : {"type" : "gauge", "help": "resource consummed by the sector"},
+        "equipment_sectors"                   : {"type" : "gauge", "help": "number of active sectors sharing the equipment (usage global) or sealed on it (usage sealing)"},
+        "equipment_sealing_jobs"              : {"type" : "gauge", "help": "number of sealing jobs running on the equipment by task"},
+        "equipment_storage_sectors"           : {"type" : "gauge", "help": "number of sector files stored on the equipment"},
+        "equipment_storage_bytes"             : {"type" : "gauge", "help": "size of the sector files stored on the equipment"}
     }
 
-    __metrics = []
+    # Number of samples written to the output at once
+    __WRITE_CHUNK_SIZE = 10000
 
     def __init__(self, output=sys.stdout):
         self.__start_time = time.time()
         self.__last_collector_start_time = self.__start_time
         self._output = output
 
+        # Samples are stored preformatted and grouped by family as they are added : {name: [line, ...]}
+        self.__families = {}
+
     def __enter__(self):
         return self
 
@@ -204,7 +298,7 @@ class Metrics():
                 success = 0
 
             # Clear the existing metrics list
-            self.__metrics = []
+            self.__families = {}
 
         self.add("scrape_execution_succeed", value=success)
         self.print_all()
@@ -212,36 +306,30 @@ class Metrics():
     def add(self, metric: str = "", value: float = 1, **labels):
         """ add a new metrics """
 
-        # Check if metric is in the list of the metrics allowed
-        if metric in self.__METRICS_LIST.keys():
-            self.__metrics.append({"name": metric, "labels": labels, "value": value})
-        else:
-            raise Exception(f'metric "{metric}" undefined in __METRICS_LIST')
+        try:
+            family = self.__families[metric]
+        except KeyError:
+            # Check if metric is in the list of the metrics allowed
+            if metric not in self.__METRICS_LIST.keys():
+                raise Exception(f'metric "{metric}" undefined in __METRICS_LIST')
+            family = self.__families[metric] = []
+
+        labels_str = ", ".join([f'{ name }="{ label }"' for name, label in labels.items()])
+        family.append(f'{self.__PREFIX}{ metric } {{ { labels_str } }} { value }\n')
 
     def print_all(self):
         """ printout all the metrics """
 
-        prev = {}
-        # go through all metrics in alphabetic order
-        for metric in sorted(self.__metrics, key=lambda m: m['name']):
-            m_name = metric["name"]
-
-            # Check if a the HELP and TYPE has already been displayed written
-            if prev == {} or m_name is not prev["name"]:
-                print(f'# HELP {self.__PREFIX}{ m_name } { self.__METRICS_LIST[m_name]["help"] }', file=self._output)
-                print(f'# TYPE {self.__PREFIX}{ m_name } { self.__METRICS_LIST[m_name]["type"] }', file=self._output)
-
-            # Printout the formatted metric
-            print(f'{self.__PREFIX}{ m_name } {{ ', end="", file=self._output)
-            first = True
-            for i in metric["labels"].keys():
-                if first is True:
-                    first = False
-                else:
-                    print(', ', end="", file=self._output)
-                print(f'{ i }="{ metric["labels"][i] }"', end="", file=self._output)
-            print(f' }} { metric["value"] }', file=self._output)
-            prev = metric
+        # go through all metrics families in alphabetic order
+        for m_name in sorted(self.__families):
+            family = self.__families[m_name]
+            self._output.write(f'# HELP {self.__PREFIX}{ m_name } { self.__METRICS_LIST[m_name]["help"] }\n'
+                               f'# TYPE {self.__PREFIX}{ m_name } { self.__METRICS_LIST[m_name]["type"] }\n')
+
+            # Write the preformatted samples by large chunks
+            for start in range(0, len(family), self.__WRITE_CHUNK_SIZE):
+                self._output.write("".join(family[start:start + self.__WRITE_CHUNK_SIZE]))
+        self._output.flush()
 
     def checkpoint(self, collector_name):
         """Measure time for each category of calls to api and generate metrics"""
@@ -273,21 +361,30 @@ def load_toml(toml_file):
     else:
         return nested_dict
 
-def collect(miner, metrics, addresses_config, green):
-    """ run metrics collection and export """
+def collect(miner, metrics, addresses_config, green, locations_file=None):
+    """ run metrics collection and export. The sector locations are kept in locations_file between the runs"""
 
     # miner_id
     miner_id = miner.id()
 
+    # In aggregated mode the sectors are counted by equipment instead of one sector_resource per sector and equipment,
+    # the per sector detail is only kept for the sectors still sealing (sealing_sector_detail)
+    aggregated = green.get("mode", "sector") == "aggregated"
+    sector_detail = not aggregated or green.get("sealing_sector_detail", False)
+    sealing_jobs = Counter()
+    sealing_equipment_sectors = {}
+
     # GENERATE WORKER INFOS
     workerstats = miner.get("WorkerStats", [])
 
     # GENERATE JOB INFOS
     workerjobs = miner.get("WorkerJobs", [])
+    sealing_sectors = set()
     for (wrk, job_list) in workerjobs["result"].items():
         for job in job_list:
             # job_id = job['ID']['ID']
             sector = str(job['Sector']['Number'])
+            sealing_sectors.add(job['Sector']['Number'])
 
             try:
                 worker_host = workerstats["result"][wrk]["Info"]["Hostname"]
@@ -300,6 +397,10 @@ def collect(miner, metrics, addresses_config, green):
             except Exception:
                 print(f'Error: {worker_host} not defined in config file [green.worker_equipments]')
                 exit(1)
+            sealing_jobs[(equipment, job.get("Task", "unknown"))] += 1
+            sealing_equipment_sectors.setdefault(equipment, set()).add(job['Sector']['Number'])
+            if not sector_detail:
+                continue
             metrics.add("sector_resource", value=1, miner_id=miner_id, sector_id=sector, equipment=equipment)
 
             # GREEN METRICS ADD GLOBAL RESSOURCES TO ALL ACTIVE SECTORS
@@ -307,6 +408,12 @@ def collect(miner, metrics, addresses_config, green):
             for equipment in green["global_infra_equipment"]:
                 metrics.add("sector_resource", value=1, miner_id=miner_id, sector_id=sector, equipment=equipment)
 
+    if aggregated:
+        for (equipment, task), jobs in sorted(sealing_jobs.items()):
+            metrics.add("equipment_sealing_jobs", value=jobs, miner_id=miner_id, equipment=equipment, task=task)
+        for equipment, sectors in sorted(sealing_equipment_sectors.items()):
+            metrics.add("equipment_sectors", value=len(sectors), miner_id=miner_id, equipment=equipment, usage="sealing")
+
     metrics.checkpoint("Sealing Sectors")
 
     sector_list_stripped = miner.get("SectorsListInStates", [["Proving", "Available"]])["result"]
@@ -315,33 +422,75 @@ def collect(miner, metrics, addresses_config, green):
 
     metrics.checkpoint("GetListDiff")
 
-    request_location = []
     miner_num=int(miner_id[2:])
 
-    # We go though all sectors and enhanced them
-    for i, sector in enumerate(unique_sector_list):
-        # GREEN METRICS ADD GLOBAL RESSOURCES TO ALL ACTIVE SECTORS
-        metrics.add("sector_resource", value=1, miner_id=miner_id, sector_id=sector, equipment=green["worker_equipments"]["miner"])
-        for equipment in green["global_infra_equipment"]:
-            metrics.add("sector_resource", value=1, miner_id=miner_id, sector_id=sector, equipment=equipment)
-
-        # GREEN GENERATE THE LIST OF ALL STORAGE RESSOURCES TO RETRIEVE FOR LONGTERM SECTORS (PROVING | AVAILABLE)
-        request_location.append(["StorageFindSector", [{"Miner":miner_num, "Number":sector}, 2, 0, False]])
-        request_location.append(["StorageFindSector", [{"Miner":miner_num, "Number":sector}, 1, 0, False]])
+    # GREEN AGGREGATED GLOBAL RESSOURCES : ALL THE ACTIVE SECTORS (LONGTERM AND SEALING)
+    if aggregated:
+        active_sectors = len(unique_sector_list | sealing_sectors)
+        for equipment in [green["worker_equipments"]["miner"]] + green["global_infra_equipment"]:
+            metrics.add("equipment_sectors", value=active_sectors, miner_id=miner_id, equipment=equipment, usage="global")
+    else:
+        # We go though all sectors and enhanced them
+        for i, sector in enumerate(unique_sector_list):
+            # GREEN METRICS ADD GLOBAL RESSOURCES TO ALL ACTIVE SECTORS
+            metrics.add("sector_resource", value=1, miner_id=miner_id, sector_id=sector, equipment=green["worker_equipments"]["miner"])
+            for equipment in green["global_infra_equipment"]:
+                metrics.add("sector_resource", value=1, miner_id=miner_id, sector_id=sector, equipment=equipment)
 
     metrics.checkpoint("Proving Sectors")
 
-    # We execute the batch
-    location = miner.get_multiple(request_location)
-    for loc in location:
+    # GREEN LOCATIONS OF THE SEALED AND UNSEALED FILES OF THE LONGTERM SECTORS (PROVING | AVAILABLE)
+    # From the last run, only the new sectors and the sectors of the sealing jobs (this run and the previous one) are resolved again
+    file_types = (2, 1)
+    max_age = green.get("location_cache_max_age", 3600)
+    locations = SectorLocations.load(locations_file, miner_id) if locations_file and max_age > 0 else None
+    if locations is not None and time.time() - locations.refreshed < max_age:
+        to_resolve = {sector for sector in unique_sector_list if (sector, 2) not in locations.index}
+        to_resolve |= (locations.pending | sealing_sectors) & unique_sector_list
+        if len(to_resolve) > SectorLocations.resolve_limit:
+            locations = None
+    else:
+        locations = None
+
+    # Otherwise all the files are indexed from the storage list (one call). A sector without sealed file in the index or with
+    # a file declared in several storages is resolved with StorageFindSector
+    if locations is None:
+        locations = SectorLocations(miner_id, miner.get_sector_locations(file_types), time.time())
+        to_resolve = {sector for sector in unique_sector_list if (sector, 2) not in locations.index or None in [locations.index.get((sector, file_type), "") for file_type in file_types]}
+
+    request_location = [(sector, file_type) for sector in to_resolve for file_type in file_types]
+    location = miner.get_multiple([["StorageFindSector", [{"Miner":miner_num, "Number":sector}, file_type, 0, False]] for sector, file_type in request_location]) if request_location else []
+    for key, loc in zip(request_location, location):
         try:
-            sector_id=loc["result"][0]["URLs"][0].split("-")[-1:][0]
-            sector_type=loc["result"][0]["URLs"][0].split("/")[-2:-1][0]
-            sector_storage_id=loc["result"][0]["ID"]
-            sector_location=green["storage_equipments"][sector_storage_id]
-            metrics.add("sector_resource", value=1, miner_id=miner_id, sector_id=sector_id, equipment=sector_location, sector_file_type=sector_type, storage_id=sector_storage_id)
-        except Exception as exp:
-            pass
+            locations.index[key] = loc["result"][0]["ID"]
+        except Exception:
+            locations.index.pop(key, None)
+
+    if locations_file and max_age > 0:
+        locations.pending = sealing_sectors
+        locations.save(locations_file, unique_sector_list)
+
+    storage_files = Counter()
+    for sector in unique_sector_list:
+        for file_type in file_types:
+            try:
+                sector_storage_id = locations.index[(sector, file_type)]
+                sector_location=green["storage_equipments"][sector_storage_id]
+            except Exception:
+                continue
+            if aggregated:
+                storage_files[(sector_location, sector_storage_id, file_type)] += 1
+            else:
+                metrics.add("sector_resource", value=1, miner_id=miner_id, sector_id=sector, equipment=sector_location, sector_file_type=miner.file_types[file_type], storage_id=sector_storage_id)
+
+    # The size of the files is derived from the sector size by file type, none is exported for the file types of unknown size
+    if storage_files:
+        sector_size = miner.sector_size()
+        for (equipment, storage_id, file_type), files in sorted(storage_files.items()):
+            labels = {"miner_id": miner_id, "equipment": equipment, "sector_file_type": miner.file_types[file_type], "storage_id": storage_id}
+            metrics.add("equipment_storage_sectors", value=files, **labels)
+            if file_type in miner.file_sizes:
+                metrics.add("equipment_storage_bytes", value=files * sector_size * miner.file_sizes[file_type], **labels)
 
     metrics.checkpoint("Storage")
 
@@ -385,7 +534,7 @@ def run(args, output):
         addresses_config = load_toml(args.farcaster_config_folder.joinpath("addresses.toml"))
 
         # execute the collector
-        collect(miner, metrics, addresses_config, config["green"])
+        collect(miner, metrics, addresses_config, config["green"], args.farcaster_config_folder.joinpath("green_sector_locations.json"))
 
 def main():
     """ main function """
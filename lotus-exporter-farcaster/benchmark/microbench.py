@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# pylint: disable=C0301, C0103
+"""
+@author: s0nik42
+Copyright (c) 2020 Julien NOEL (s0nik42)
+
+MIT License
+
+Microbenchmarks of the hot helpers of lotus-exporter-farcaster, executed hundreds of thousands of times per scrape on
+big miners. Inputs are generated to look like large miners : dense and fragmented partition bitfields, long sealing
+logs, million-sample metric sets. Timings are compared to the baselines stored in baselines.json, a benchmark slower
+than its baseline by more than the tolerance is reported as a regression and the exit code is 1.
+Baselines depend on the machine : record them with --save on the machine used to compare. --memory reports instead the
+peak memory (tracemalloc) of the data structures holding the sectors of a scrape.
+"""
+
+from pathlib import Path
+import argparse
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+EXPORTER = Path(__file__).resolve().parent.parent.joinpath("lotus-exporter-farcaster.py")
+BASELINES = Path(__file__).resolve().parent.joinpath("baselines.json")
+
+SECTOR_SIZE = 34359738368
+PARTITION_SIZE = 2349
+
+# {name: (setup function, number of operations of one run, ops multiplied by --scale)}
+BENCHMARKS = {}
+
+# {name: (setup function, number of sectors)}, the setup function returns the function building the measured structure
+MEMORY_BENCHMARKS = {}
+
+def benchmark(name, ops=1, scaled=False):
+    """ register a benchmark : the decorated function takes (exporter module, scale) and returns the function to time"""
+    def register(setup):
+        BENCHMARKS[name] = (setup, ops, scaled)
+        return setup
+    return register
+
+def memory_benchmark(name, sectors=100000):
+    """ register a memory benchmark : the decorated function takes (exporter module, sectors) and returns the function
+    building the structure"""
+    def register(setup):
+        MEMORY_BENCHMARKS[name] = (setup, sectors)
+        return setup
+    return register
+
+def load_exporter():
+    """ import lotus-exporter-farcaster.py as a module"""
+    spec = importlib.util.spec_from_file_location("lotus_exporter_farcaster", EXPORTER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def dense_bitfield():
+    """ a full partition"""
+    return [1000000, PARTITION_SIZE]
+
+def fragmented_bitfield():
+    """ a partition where every other sector is set"""
+    return [1000000, 1] + [1, 1] * (PARTITION_SIZE // 2)
+
+def sector_log(entries=300):
+    """ log of a sector that went through many retries before being finalized"""
+    log = [{"Kind": "event;sealing.SectorStartCC", "Timestamp": 1700000000, "Trace": "", "Message": ""}]
+    for n in range(entries - 3):
+        log.append({"Kind": "event;sealing.SectorRetryPreCommit1" if n % 2 else "event;sealing.SectorSealPreCommit1Failed", "Timestamp": 1700000000 + n, "Trace": "", "Message": "retry"})
+    log.append({"Kind": "event;sealing.SectorPacked", "Timestamp": 1700001000, "Trace": "", "Message": ""})
+    log.append({"Kind": "event;sealing.SectorFinalized", "Timestamp": 1700002000, "Trace": "", "Message": ""})
+    return log
+
+@benchmark("bitfield_count_fragmented", ops=1)
+def bench_bitfield_count(exporter, scale):
+    bitfield = fragmented_bitfield()
+    return lambda: exporter.Lotus.bitfield_count(bitfield)
+
+@benchmark("bitfield_to_dict_dense", ops=1)
+def bench_bitfield_to_dict_dense(exporter, scale):
+    bitfield = dense_bitfield()
+    return lambda: exporter.Lotus.bitfield_to_dict(bitfield, "Live")
+
+@benchmark("bitfield_to_dict_fragmented", ops=1)
+def bench_bitfield_to_dict_fragmented(exporter, scale):
+    bitfield = fragmented_bitfield()
+    return lambda: exporter.Lotus.bitfield_to_dict(bitfield, "Faulty")
+
+@benchmark("sector_table_partition_dense", ops=1)
+def bench_partition_dense(exporter, scale):
+    bitfield = dense_bitfield()
+    table = exporter.SectorTable()
+    flags = exporter.Sector.partition_flags
+    def run():
+        for state in flags:
+            table.add_partition_bitfield(bitfield, flags[state], 1, 0)
+    return run
+
+@benchmark("sector_table_partition_fragmented", ops=1)
+def bench_partition_fragmented(exporter, scale):
+    bitfield = fragmented_bitfield()
+    table = exporter.SectorTable()
+    flags = exporter.Sector.partition_flags
+    def run():
+        for state in flags:
+            table.add_partition_bitfield(bitfield, flags[state], 1, 0)
+    return run
+
+@benchmark("qa_power_for_weight", ops=10000)
+def bench_qa_power(exporter, scale):
+    qa_power_for_weight = exporter.Lotus.qa_power_for_weight
+    deal_weight = SECTOR_SIZE * 1000000
+    def run():
+        for duration in range(1500000, 1510000):
+            qa_power_for_weight(SECTOR_SIZE, duration, deal_weight, deal_weight * 2)
+    return run
+
+@benchmark("get_url_and_token", ops=10000)
+def bench_get_url_and_token(exporter, scale):
+    api = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJBbGxvdyI6WyJyZWFkIl19.signature:/ip4/192.168.1.10/tcp/2345/http"
+    get_url_and_token = exporter.get_url_and_token
+    def run():
+        for _ in range(10000):
+            get_url_and_token(api)
+    return run
+
+@benchmark("sector_set_log", ops=1000)
+def bench_sector_log(exporter, scale):
+    log = sector_log()
+    sectors = [exporter.Sector(sector_id) for sector_id in range(1000)]
+    def run():
+        for sector in sectors:
+            sector.set_log(log)
+    return run
+
+@benchmark("sector_table_add_status", ops=1000)
+def bench_add_status(exporter, scale):
+    status = {"State": "Proving", "ToUpgrade": False, "Deals": [1234], "Activation": 1000000, "Expiration": 6000000,
+              "DealWeight": "0", "VerifiedDealWeight": str(SECTOR_SIZE * 5000000), "Log": sector_log(20)}
+    def run():
+        table = exporter.SectorTable()
+        for sector_id in range(1000):
+            table.add_status(sector_id, status, SECTOR_SIZE)
+    return run
+
+def sector_status_body():
+    """ SectorsStatus response of a sector with a deal and a short sealing log"""
+    return json.dumps({"State": "Proving", "ToUpgrade": False, "Deals": [1234], "Activation": 1000000, "Expiration": 6000000,
+                       "DealWeight": "0", "VerifiedDealWeight": str(SECTOR_SIZE * 5000000), "Log": sector_log(20)})
+
+@memory_benchmark("sector_status_json")
+def memory_sector_json(exporter, sectors):
+    # the decoded SectorsStatus responses of all the sectors, as held by collect() before SectorTable
+    body = sector_status_body()
+    return lambda: {sector_id: json.loads(body) for sector_id in range(sectors)}
+
+@memory_benchmark("sector_table")
+def memory_sector_table(exporter, sectors):
+    # the responses are decoded one by one and released once added to the table
+    body = sector_status_body()
+    def run():
+        table = exporter.SectorTable()
+        for sector_id in range(sectors):
+            table.add_status(sector_id, json.loads(body), SECTOR_SIZE)
+        return table
+    return run
+
+def metrics_samples(metrics, samples):
+    """ add the per sector families of a miner with samples / 4 sectors"""
+    for sector_id in range(samples // 4):
+        metrics.add("miner_sector_state", value=1, miner_id="f01000", sector_id=sector_id, state="Proving", to_upgrade=False, pledged=1, deals=0)
+        metrics.add("miner_sector_weight", value=0, weight_type="verified", miner_id="f01000", sector_id=sector_id)
+        metrics.add("miner_sector_qa_power", value=SECTOR_SIZE, miner_id="f01000", sector_id=sector_id)
+        metrics.add("miner_deadline_active_partition_sector", value=1, miner_id="f01000", deadline_id=sector_id % 48, partition_id=0, sector_id=sector_id, state="Active")
+
+@benchmark("metrics_add", ops=1000000, scaled=True)
+def bench_metrics_add(exporter, scale):
+    samples = int(1000000 * scale)
+    return lambda: metrics_samples(exporter.Metrics(output=io.StringIO()), samples)
+
+@benchmark("metrics_print_all", ops=1000000, scaled=True)
+def bench_metrics_print_all(exporter, scale):
+    samples = int(1000000 * scale)
+    metrics = exporter.Metrics(output=open(os.devnull, "w", encoding="utf-8"))
+    metrics_samples(metrics, samples)
+    return metrics.print_all
+
+@benchmark("cold_start", ops=1)
+def bench_cold_start(exporter, scale):
+    # start of a new exporter process until its arguments are parsed : interpreter and imports, paid by every cron run
+    command = [sys.executable, str(EXPORTER), "--version"]
+    return lambda: subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+
+def machine():
+    """ description of the machine the benchmarks run on"""
+    return f"{platform.python_implementation()} {platform.python_version()} {platform.machine()} {os.cpu_count()} cpus"
+
+def measure_memory(exporter, names, scale):
+    """ print the peak memory of the memory benchmarks, per sector"""
+    print(f"{'benchmark':<36} {'sectors':>10} {'peak':>12} {'per sector':>12}")
+    for name in names:
+        setup, sectors = MEMORY_BENCHMARKS[name]
+        sectors = int(sectors * scale)
+        run = setup(exporter, sectors)
+        tracemalloc.start()
+        structure = run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del structure
+        print(f"{name:<36} {sectors:>10} {peak / 2**20:>10.1f}MB {peak / sectors:>11.0f}B")
+
+def main():
+    """ main function """
+    parser = argparse.ArgumentParser(description="lotus-exporter-farcaster microbenchmarks")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default all)")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs of each benchmark, the fastest is kept")
+    parser.add_argument("--scale", type=float, default=1, help="scale the size of the metric sets (default 1 : one million samples)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown over the baseline reported as a regression (default 0.25)")
+    parser.add_argument("--baselines", type=Path, default=BASELINES, help="baselines file")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks")
+    parser.add_argument("--memory", action="store_true", help="report the peak memory of the sector structures instead of timings")
+    args = parser.parse_args()
+
+    benchmarks = MEMORY_BENCHMARKS if args.memory else BENCHMARKS
+    if args.list:
+        print("\n".join(benchmarks))
+        return 0
+
+    names = args.names or list(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            parser.error(f"unknown benchmark {name}")
+
+    if args.memory:
+        measure_memory(load_exporter(), names, args.scale)
+        return 0
+
+    baselines = json.loads(args.baselines.read_text()) if args.baselines.exists() else {"machine": None, "results": {}}
+    if baselines["machine"] not in (None, machine()):
+        print(f"WARNING : baselines recorded on {baselines['machine']}, running on {machine()}")
+
+    exporter = load_exporter()
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<36} {'per op':>12} {'baseline':>12} {'ratio':>7}")
+    for name in names:
+        setup, ops, scaled = BENCHMARKS[name]
+        run = setup(exporter, args.scale)
+        ops = int(ops * args.scale) if scaled else ops
+        results[name] = min(timeit.repeat(run, number=1, repeat=args.repeat)) / ops
+
+        baseline = baselines["results"].get(name)
+        if baseline:
+            ratio = results[name] / baseline
+            status = "  REGRESSION" if ratio > 1 + args.tolerance else ""
+            if status:
+                regressions.append(name)
+            print(f"{name:<36} {results[name] * 1e6:>10.3f}us {baseline * 1e6:>10.3f}us {ratio:>6.2f}x{status}")
+        else:
+            print(f"{name:<36} {results[name] * 1e6:>10.3f}us {'-':>12} {'-':>7}")
+
+    if args.save:
+        baselines = {"machine": machine(), "results": {**baselines["results"], **results}}
+        args.baselines.write_text(json.dumps(baselines, indent=4, sort_keys=True) + "\n")
+        print(f"baselines saved to {args.baselines}")
+        return 0
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) : {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
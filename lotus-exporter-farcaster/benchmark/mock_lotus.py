@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# pylint: disable=C0301, C0103, W0613
+"""
+@author: s0nik42
+Copyright (c) 2020 Julien NOEL (s0nik42)
+
+MIT License
+
+Synthetic Lotus daemon / miner / Boost server used to benchmark lotus-exporter-farcaster without a real miner.
+The same port serves the JSON-RPC API (/rpc/v0) of the daemon, the miner and boost, and the Boost GraphQL
+dealPublish query (/graphql/query). Responses are generated from the number of sectors of the miner :
+    - most of the sectors are Proving, SEALING_RATIO of them are sealing
+    - on-chain sectors are laid out in partitions of PARTITION_SIZE sectors spread over the 48 deadlines
+    - one sector out of DEAL_RATIO has a deal
+Every call can be delayed by a fixed latency. GET /stats returns the number of calls per method since the last GET /stats
+POST /api/v1/write receives the Prometheus remote write requests of the exporter, the decoded samples are kept in
+MockHandler.written
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import collections
+import json
+import struct
+import threading
+import time
+
+MINER_ID = "f01000"
+SECTOR_SIZE = 34359738368
+PARTITION_SIZE = 2349
+DEADLINES = 48
+SEALING_RATIO = 0.01
+DEAL_RATIO = 3
+SECTORS_PER_STORAGE = 50000
+
+SEALING_STATES = ["PreCommit1", "PreCommit2", "WaitSeed", "Committing", "SubmitCommit", "FinalizeSector"]
+
+class MockMiner():
+    """ Generate the API responses of a miner with sectors sectors"""
+
+    def __init__(self, sectors, workers=None):
+        self.sectors = sectors
+        self.sealing = int(sectors * SEALING_RATIO)
+        self.onchain = sectors - self.sealing
+        self.workers = workers or min(sectors // 1000 + 1, 100)
+        self.storages = sectors // SECTORS_PER_STORAGE + 1
+        self.head = {"Cids": [{"/": "bafy2bzacea"}], "Height": 4000000, "Blocks": [{"ParentBaseFee": "100"}]}
+        self.methods = {
+            "ChainHead":                    lambda params: self.head,
+            "StateNetworkVersion":          lambda params: 23,
+            "StateNetworkName":             lambda params: "mainnet",
+            "StateActorCodeCIDs":           lambda params: {"account": {"/": "bafk2bzaceaccount"}, "storageminer": {"/": "bafk2bzaceminer"}, "multisig": {"/": "bafk2bzacemultisig"}},
+            "Version":                      lambda params: {"Version": "1.28.1+mainnet", "APIVersion": 66816, "BlockDelay": 30},
+            "ActorAddress":                 lambda params: MINER_ID,
+            "ActorSectorSize":              lambda params: SECTOR_SIZE,
+            "SyncState":                    lambda params: {"ActiveSyncs": [{"Height": self.head["Height"], "Stage": 7}]},
+            "StateMinerInfo":               lambda params: {"Owner": "f0100", "Worker": "f0101", "ControlAddresses": ["f0102"], "SectorSize": SECTOR_SIZE},
+            "StateAccountKey":              lambda params: f"f3{params[0][2:]}key",
+            "StateLookupID":                lambda params: "f0100",
+            "StateGetActor":                lambda params: {"Code": {"/": "bafk2bzaceaccount"}, "Balance": "1000"},
+            "NetAutoNatStatus":             lambda params: {"Reachability": 1},
+            "WalletList":                   lambda params: ["f3wallet1", "f3wallet2"],
+            "WalletBalance":                lambda params: "1000000000000000000",
+            "StateVerifiedClientStatus":    lambda params: None,
+            "StateMinerAvailableBalance":   lambda params: "5000000000000000000",
+            "StateReadState":               lambda params: {"State": {"PreCommitDeposits": "1", "LockedFunds": "2", "FeeDebt": "0", "InitialPledge": "3"}},
+            "StateMinerPower":              lambda params: {"MinerPower": {"RawBytePower": str(self.onchain * SECTOR_SIZE), "QualityAdjPower": str(self.onchain * SECTOR_SIZE)},
+                                                            "TotalPower": {"RawBytePower": "1", "QualityAdjPower": "1"}},
+            "MinerGetBaseInfo":             lambda params: {"EligibleForMining": True},
+            "MpoolPending":                 lambda params: [{"Message": {"From": "f3wallet1", "To": MINER_ID, "Method": 5, "Nonce": n, "Value": "0", "GasLimit": 1, "GasFeeCap": "1", "GasPremium": "1"}} for n in range(10)],
+            "NetPeers":                     lambda params: [{"ID": f"12D3Koo{n}"} for n in range(200)],
+            "NetBandwidthStatsByProtocol":  lambda params: {f"/fil/proto/{n}": {"TotalIn": n, "TotalOut": n} for n in range(20)},
+            "NetBandwidthStats":            lambda params: {"TotalIn": 10, "TotalOut": 20},
+            "WorkerStats":                  self.worker_stats,
+            "WorkerJobs":                   self.worker_jobs,
+            "SealingSchedDiag":             lambda params: {"SchedInfo": {"Requests": [{"Sector": {"Number": self.onchain + n}, "TaskType": "seal/v0/commit/2"} for n in range(min(self.sealing, 20))]}},
+            "SectorsList":                  lambda params: list(range(self.sectors)),
+            "SectorsListInStates":          lambda params: list(range(self.onchain)) if "Proving" in params[0] else [],
+            "SectorsStatus":                self.sector_status,
+            "StateMinerSectors":            self.miner_sectors,
+            "StateMarketStorageDeal":       self.deal,
+            "StateMinerDeadlines":          lambda params: [{"PostSubmissions": [0, 1]} for _ in range(DEADLINES)],
+            "StateMinerProvingDeadline":    lambda params: {"Index": 3, "Open": self.head["Height"] - 10, "Close": self.head["Height"] + 50, "CurrentEpoch": self.head["Height"], "WPoStPeriodDeadlines": DEADLINES, "WPoStChallengeWindow": 60},
+            "StateMinerPartitions":         self.partitions,
+            "StorageList":                  self.storage_list,
+            "StorageFindSector":            self.find_sector,
+            "StorageLocal":                 lambda params: {f"storage{n}": f"/mnt/storage{n}" for n in range(self.storages)},
+            "StorageInfo":                  lambda params: {"ID": params[0], "URLs": ["http://127.0.0.1:2345/remote"], "Weight": 10, "CanSeal": False, "CanStore": True},
+            "StorageStat":                  lambda params: {"Capacity": 10**15, "Available": 10**14, "Reserved": 0},
+        }
+
+    def call(self, method, params):
+        """ return the JSON-RPC response of method"""
+        if method not in self.methods:
+            return {"jsonrpc": "2.0", "id": 3, "error": {"code": -32601, "message": f"method '{method}' not found"}}
+        return {"jsonrpc": "2.0", "id": 3, "result": self.methods[method](params)}
+
+    def worker_stats(self, params):
+        return {f"worker{n}": {"Info": {"Hostname": f"worker{n}", "Resources": {"CPUs": 64, "GPUs": ["RTX 3090"], "MemPhysical": 2**39, "MemSwap": 2**36, "MemReserved": 2**30}},
+                               "MemUsedMin": 2**35, "MemUsedMax": 2**36, "GpuUsed": n % 2 == 0, "CpuUse": n % 64} for n in range(self.workers)}
+
+    def worker_jobs(self, params):
+        return {f"worker{n}": [{"ID": {"ID": f"job{n}"}, "Sector": {"Number": self.onchain + n}, "Task": "seal/v0/precommit/1", "Start": "2024-01-01T00:00:00.000Z", "RunWait": 0}]
+                for n in range(min(self.workers, self.sealing))}
+
+    def sector_status(self, params):
+        sector = params[0]
+        onchain = sector < self.onchain
+        deals = [sector] if sector % DEAL_RATIO == 0 else []
+        log = [{"Kind": "event;sealing.SectorStart" if deals else "event;sealing.SectorStartCC", "Timestamp": 1700000000 + sector},
+               {"Kind": "event;sealing.SectorPacked", "Timestamp": 1700000100 + sector}]
+        if onchain:
+            log.append({"Kind": "event;sealing.SectorFinalized", "Timestamp": 1700010000 + sector})
+        return {"SectorID": sector, "State": "Proving" if onchain else SEALING_STATES[sector % len(SEALING_STATES)], "Deals": deals or [0], "ToUpgrade": False,
+                "Activation": 1000000, "Expiration": 6000000, "DealWeight": "0", "VerifiedDealWeight": str(SECTOR_SIZE * 5000000) if deals else "0", "Log": log}
+
+    def miner_sectors(self, params):
+        return [{"SectorNumber": sector, "DealIDs": [sector] if sector % DEAL_RATIO == 0 else None, "Activation": 1000000, "Expiration": 6000000,
+                 "DealWeight": "0", "VerifiedDealWeight": str(SECTOR_SIZE * 5000000) if sector % DEAL_RATIO == 0 else "0"} for sector in range(self.onchain)]
+
+    def deal(self, params):
+        return {"Proposal": {"Client": "f0100", "Provider": MINER_ID, "VerifiedDeal": True, "PieceSize": SECTOR_SIZE, "StoragePricePerEpoch": "0",
+                             "ProviderCollateral": "0", "ClientCollateral": "0", "StartEpoch": 1000000, "EndEpoch": 6000000}}
+
+    def partitions(self, params):
+        """ partition p of deadline d holds the on-chain sectors [(p * DEADLINES + d) * PARTITION_SIZE, +PARTITION_SIZE[
+        bitfields are run length lists. The first sector of one partition out of 7 is faulty"""
+        deadline = params[1]
+        result = []
+        partition = 0
+        while (partition * DEADLINES + deadline) * PARTITION_SIZE < self.onchain:
+            index = partition * DEADLINES + deadline
+            start = index * PARTITION_SIZE
+            length = min(PARTITION_SIZE, self.onchain - start)
+            faulty = index % 7 == 3
+            result.append({"AllSectors": [start, length], "LiveSectors": [start, length], "UnprovenSectors": [],
+                           "FaultySectors": [start, 1] if faulty else [], "RecoveringSectors": [],
+                           "ActiveSectors": [start + 1, length - 1] if faulty else [start, length]})
+            partition += 1
+        return result
+
+    def storage_list(self, params):
+        """ sealed file of every sector and unsealed file of the deal sectors"""
+        result = {f"storage{n}": [] for n in range(self.storages)}
+        for sector in range(self.sectors):
+            storage = result[f"storage{sector // SECTORS_PER_STORAGE}"]
+            storage.append({"Miner": int(MINER_ID[2:]), "Number": sector, "SectorFileType": 2})
+            if sector % DEAL_RATIO == 0:
+                storage.append({"Miner": int(MINER_ID[2:]), "Number": sector, "SectorFileType": 1})
+        return result
+
+    def find_sector(self, params):
+        """ storage of a sector file, as declared by storage_list"""
+        sector, file_type = params[0]["Number"], params[1]
+        if sector >= self.sectors or (file_type == 1 and sector % DEAL_RATIO != 0) or file_type not in (1, 2):
+            return []
+        storage = f"storage{sector // SECTORS_PER_STORAGE}"
+        name = "sealed" if file_type == 2 else "unsealed"
+        return [{"ID": storage, "URLs": [f"http://127.0.0.1:2345/remote/{name}/s-t0{MINER_ID[2:]}-{sector}"], "Weight": 10, "CanSeal": False, "CanStore": True, "Primary": True}]
+
+    def deal_publish(self):
+        """ Boost GraphQL dealPublish"""
+        return {"data": {"dealPublish": {"Start": "2024-01-01T00:00:00.123456789+00:00", "Period": 3600000000000,
+                                         "Deals": [{"ID": f"deal{n}", "ClientAddress": "f0100", "PieceSize": {"n": str(SECTOR_SIZE)}, "StartEpoch": {"n": "1000000"},
+                                                    "EndEpoch": {"n": "6000000"}, "ProviderCollateral": {"n": "0"}} for n in range(5)]}}}
+
+def read_varint(data, position):
+    """ return the protobuf varint at position and the position after it"""
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+def snappy_decompress(data):
+    """ decode a snappy block : literals and copies"""
+    length, position = read_varint(data, 0)
+    output = bytearray()
+    while position < len(data):
+        tag = data[position]
+        position += 1
+        if tag & 3 == 0:
+            size = tag >> 2
+            if size >= 60:
+                size = int.from_bytes(data[position:position + size - 59], "little")
+                position += (tag >> 2) - 59
+            output += data[position:position + size + 1]
+            position += size + 1
+            continue
+        if tag & 3 == 1:
+            size = (tag >> 2 & 7) + 4
+            offset = (tag >> 5) << 8 | data[position]
+            position += 1
+        else:
+            size = (tag >> 2) + 1
+            offset_bytes = 2 if tag & 3 == 2 else 4
+            offset = int.from_bytes(data[position:position + offset_bytes], "little")
+            position += offset_bytes
+        # a copy can overlap the bytes it produces
+        for _ in range(size):
+            output.append(output[-offset])
+    if len(output) != length:
+        raise ValueError(f"snappy block of {len(output)} bytes, {length} expected")
+    return bytes(output)
+
+def protobuf_fields(data):
+    """ yield the (field number, value) of a protobuf message : int for varints, bytes for fixed64 and length-delimited fields"""
+    position = 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        if key & 7 == 0:
+            value, position = read_varint(data, position)
+        elif key & 7 == 1:
+            value, position = data[position:position + 8], position + 8
+        elif key & 7 == 2:
+            size, position = read_varint(data, position)
+            value, position = data[position:position + size], position + size
+        else:
+            raise ValueError(f"unsupported protobuf wire type {key & 7}")
+        yield key >> 3, value
+
+def decode_write_request(body):
+    """ return the samples of a snappy compressed remote write WriteRequest : [(labels, value, timestamp in ms)]"""
+    samples = []
+    for _, series in protobuf_fields(snappy_decompress(body)):
+        labels = {}
+        points = []
+        for number, field in protobuf_fields(series):
+            fields = dict(protobuf_fields(field))
+            if number == 1:
+                labels[fields.get(1, b"").decode()] = fields.get(2, b"").decode()
+            elif number == 2:
+                points.append((struct.unpack("<d", fields.get(1, bytes(8)))[0], fields.get(2, 0)))
+        samples.extend((labels, value, timestamp) for value, timestamp in points)
+    return samples
+
+class MockServer(ThreadingHTTPServer):
+    """ Threaded server accepting the bursts of concurrent connections of the exporter"""
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+class MockHandler(BaseHTTPRequestHandler):
+    """ Serve the API of MockHandler.miner"""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately : without TCP_NODELAY, keep-alive connections wait for delayed ACKs
+    disable_nagle_algorithm = True
+    miner = None
+    latency = 0
+    calls = collections.Counter()
+    written = []
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path == "/api/v1/write":
+            samples = decode_write_request(body)
+            with self.lock:
+                self.written.extend(samples)
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        request = json.loads(body)
+        if self.path.startswith("/graphql"):
+            method = "graphql"
+            response = self.miner.deal_publish()
+        else:
+            method = request["method"].split(".", 1)[-1]
+            response = self.miner.call(method, request["params"])
+        with self.lock:
+            self.calls[method] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_json(response)
+
+    def do_GET(self):
+        """ return and reset the number of calls per method"""
+        with self.lock:
+            calls = dict(self.calls)
+            self.calls.clear()
+        self.send_json(calls)
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(sectors, latency=0, address="127.0.0.1", port=0):
+    """ start the mock server in a background thread, return the server"""
+    handler = type("Handler", (MockHandler,), {"miner": MockMiner(sectors), "latency": latency, "calls": collections.Counter(), "written": [], "lock": threading.Lock()})
+    server = MockServer((address, port), handler)
+    threading.Thread(target=server.serve_forever, name="mock_lotus", daemon=True).start()
+    return server
+
+def main():
+    """ main function """
+    parser = argparse.ArgumentParser(description="Synthetic Lotus / Boost API server")
+    parser.add_argument("--sectors", type=int, default=1000, help="number of sectors of the miner")
+    parser.add_argument("--latency", type=float, default=0, help="delay of every call in seconds")
+    parser.add_argument("--listen", default="127.0.0.1:1234", help="[ADDRESS:]PORT")
+    args = parser.parse_args()
+
+    address, _, port = args.listen.rpartition(":")
+    server = start_server(args.sectors, args.latency, address or "127.0.0.1", int(port))
+    print(f"mock lotus serving {args.sectors} sectors on http://{server.server_address[0]}:{server.server_address[1]}/rpc/v0")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# pylint: disable=C0301, C0103
+"""
+@author: s0nik42
+Copyright (c) 2020 Julien NOEL (s0nik42)
+
+MIT License
+
+End-to-end benchmark of lotus-exporter-farcaster against the synthetic Lotus / Boost server of mock_lotus.py.
+For each miner size, the exporter is run as a separate process (one-shot scrape to a file) and the suite reports
+the scrape wall time, the number of API calls, the peak RSS of the exporter and the size of the exposition.
+Results can be appended to a JSON lines file to track regressions between versions. With --remote-write, the exporter
+also pushes its samples to the mock server, which decodes them, and the pushed samples are checked against the exposition.
+"""
+
+from pathlib import Path
+import argparse
+import datetime
+import json
+import math
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import mock_lotus
+
+EXPORTER = Path(__file__).resolve().parent.parent.joinpath("lotus-exporter-farcaster.py")
+
+def write_config(folder, port, bulk=False):
+    """ write the config.toml of the exporter pointing all the APIs to the mock server"""
+    api = f"benchmark:/ip4/127.0.0.1/tcp/{port}/http"
+    with open(Path(folder).joinpath("config.toml"), "w", encoding="utf-8") as config:
+        config.write(f'miner_api = "{api}"\n'
+                     f'markets_api = "{api}"\n'
+                     f'daemon_api = "{api}"\n'
+                     f'boost_api = "{api}"\n'
+                     f'boost_graphql = "http://127.0.0.1:{port}/graphql/query"\n'
+                     f'markets_type = "boost"\n'
+                     f'sectors_bulk_onchain = {"true" if bulk else "false"}\n')
+
+def get_calls(port):
+    """ return and reset the number of calls per method of the mock server"""
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return json.loads(response.read())
+
+def run_exporter(folder, output, extra_args):
+    """ run one scrape, return (wall time, peak RSS in bytes, exit code)"""
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, str(EXPORTER), "-c", str(folder), "--file", str(output)] + extra_args, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return time.perf_counter() - start, rusage.ru_maxrss * 1024, process.returncode
+
+def scrape_succeed(output):
+    """ return the value of lotus_scrape_execution_succeed in the exposition"""
+    with open(output, encoding="utf-8") as exposition:
+        for line in exposition:
+            if line.startswith("lotus_scrape_execution_succeed"):
+                return int(float(line.rsplit(" ", 1)[1]))
+    return None
+
+def exposition_samples(output):
+    """ return the samples of the exposition pushed by remote write : {(name, sorted labels): value}"""
+    samples = {}
+    with open(output, encoding="utf-8") as exposition:
+        for line in exposition:
+            if line.startswith("#"):
+                continue
+            series, _, value = line.rstrip("\n").rpartition(" ")
+            try:
+                value = float(value)
+            except ValueError:
+                value = {"True": 1.0, "False": 0.0}.get(value)
+            if value is None:
+                continue
+            labels = [(label, re.sub(r"\\(.)", lambda match: "\n" if match.group(1) == "n" else match.group(1), label_value))
+                      for label, label_value in re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', series)]
+            samples[(re.match(r"[a-zA-Z_:][a-zA-Z0-9_:]*", series).group(0), tuple(sorted(labels)))] = value
+    return samples
+
+def check_remote_write(output, written):
+    """ compare the samples pushed by remote write (decoded by the mock server) with the exposition, return the number of
+    differences : missing, unexpected or different samples"""
+    pushed = {}
+    for labels, value, timestamp in written:
+        if timestamp <= 0:
+            return len(written)
+        labels = dict(labels)
+        name = labels.pop("__name__")
+        for external_label in ["job", "instance"]:
+            labels.pop(external_label, None)
+        pushed[(name, tuple(sorted(labels.items())))] = value
+
+    expected = exposition_samples(output)
+    differences = len(expected.keys() ^ pushed.keys())
+    for series in expected.keys() & pushed.keys():
+        if expected[series] != pushed[series] and not (math.isnan(expected[series]) and math.isnan(pushed[series])):
+            differences += 1
+    return differences
+
+def benchmark(sectors, latency, runs, bulk, extra_args, remote_write=False):
+    """ benchmark the exporter against a miner of sectors sectors"""
+    server = mock_lotus.start_server(sectors, latency)
+    port = server.server_address[1]
+    written = server.RequestHandlerClass.written
+    if remote_write:
+        extra_args = extra_args + ["--remote-write", f"http://127.0.0.1:{port}/api/v1/write"]
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            write_config(folder, port, bulk)
+            output = Path(folder).joinpath("metrics.prom")
+            for _ in range(runs):
+                get_calls(port)
+                written.clear()
+                wall_time, rss, returncode = run_exporter(folder, output, extra_args)
+                calls = get_calls(port)
+                results.append({
+                    "remote_write_differences": check_remote_write(output, written) if remote_write and output.exists() else None,
+                    "wall_time": wall_time,
+                    "rpc_calls": sum(calls.values()),
+                    "peak_rss": rss,
+                    "exposition_bytes": output.stat().st_size if output.exists() else 0,
+                    "succeed": scrape_succeed(output) if output.exists() else None,
+                    "returncode": returncode,
+                    "calls": calls
+                })
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return {
+        "sectors": sectors,
+        "latency": latency,
+        "bulk": bulk,
+        "runs": runs,
+        "wall_time": statistics.median(result["wall_time"] for result in results),
+        "wall_time_min": min(result["wall_time"] for result in results),
+        "rpc_calls": results[-1]["rpc_calls"],
+        "peak_rss": max(result["peak_rss"] for result in results),
+        "exposition_bytes": results[-1]["exposition_bytes"],
+        "succeed": all(result["succeed"] == 1 for result in results),
+        "remote_write_differences": results[-1]["remote_write_differences"],
+        "top_calls": dict(sorted(results[-1]["calls"].items(), key=lambda call: -call[1])[:5])
+    }
+
+def git_revision():
+    """ return the current git revision of the exporter, None outside of a git repository"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=EXPORTER.parent, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def main():
+    """ main function """
+    parser = argparse.ArgumentParser(description="lotus-exporter-farcaster end-to-end benchmark")
+    parser.add_argument("--sectors", type=int, nargs="+", default=[1000, 10000], help="sizes of the generated miners (default 1000 10000, also try 100000 1000000)")
+    parser.add_argument("--latency", type=float, default=0, help="delay of every API call in seconds")
+    parser.add_argument("--runs", type=int, default=3, help="number of scrapes per size, the median wall time is reported")
+    parser.add_argument("--bulk", action="store_true", help="enable sectors_bulk_onchain in the exporter configuration")
+    parser.add_argument("--remote-write", action="store_true", help="push the samples to the mock server and check them against the exposition")
+    parser.add_argument("--output", help="append the results to this JSON lines file")
+    parser.add_argument("exporter_args", nargs=argparse.REMAINDER, help="extra arguments of the exporter, after --")
+    args = parser.parse_args()
+    extra_args = [arg for arg in args.exporter_args if arg != "--"]
+
+    revision = git_revision()
+    print(f"{'sectors':>9} {'wall time':>10} {'rpc calls':>10} {'peak rss':>10} {'exposition':>11}  top calls")
+    for sectors in args.sectors:
+        result = benchmark(sectors, args.latency, args.runs, args.bulk, extra_args, args.remote_write)
+        result["revision"] = revision
+        result["date"] = datetime.datetime.now().isoformat(timespec="seconds")
+        status = "" if result["succeed"] else "  SCRAPE FAILED"
+        if result["remote_write_differences"]:
+            status += f"  REMOTE WRITE : {result['remote_write_differences']} samples differ from the exposition"
+        print(f"{sectors:>9} {result['wall_time']:>9.2f}s {result['rpc_calls']:>10} {result['peak_rss'] / 2**20:>8.1f}MB {result['exposition_bytes'] / 2**20:>9.2f}MB  {result['top_calls']}{status}")
+
+        if args.output:
+            with open(args.output, "a", encoding="utf-8") as output:
+                output.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -197,7 +197,7 @@ verify "chgrp \"$IUSER\" \"$PROMETHEUS_NODE_EXPORTER_FOLDER\""
 while true; do
     read -n 1 -s -p "Install python modules ? " yn
     case $yn in
-        [Yy]* ) echo -n "Yes"; TRACELOG=$(pip3 install py-multibase gql 2>&1); verify "pip3 install py-multibase gql"; break;;
+        [Yy]* ) echo -n "Yes"; TRACELOG=$(pip3 install gql 2>&1); verify "pip3 install gql"; break;;
         [Nn]* ) echo -e "No$SKIP"; break;;
         * ) read -t 0.01 junk; echo -e "\nPlease answer Y or N." ;;
     esac
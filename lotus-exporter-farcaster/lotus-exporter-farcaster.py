@@ -68,28 +68,51 @@ SOFTWARE.
 # v2.0.3:
 #   - Trigger exception when api return no result
 
+import time
+# Start of the process : the imports and the configuration until the first scrape are reported as the startup time
+PROCESS_START_TIME = time.time()
+
+# The imports follow the start time, they are part of the startup time
+# pylint: disable=C0413
 from urllib.parse import urlparse
 from pathlib import Path
 import json
-import time
 import sys
 import socket
 import os
+import threading
+import gzip
+import heapq
+import array
+import math
+import random
+import zlib
+import struct
+import queue
+import re
+import resource
+import collections
+import io
+import atexit
 import asyncio
 import argparse
 import logging
 from functools import wraps
 import datetime
 import toml
-import multibase
-import aiohttp
 import traceback
-from gql import gql, Client
-from gql.transport.aiohttp import AIOHTTPTransport
-from gql.transport.aiohttp import log as aiohttp_logger
+# pylint: enable=C0413
+
+# aiohttp, gql (Boost only) and the modules of the optional features (http.server for --listen, urllib.request and snappy for
+# remote write, cProfile, tracemalloc and pstats for --profile, concurrent.futures and multiprocessing for the process pool and
+# the multi-miner threads) are imported when first used : a one-shot scrape from cron would pay them at every run
 
 VERSION = "v3.0.2"
 
+# Mainnet genesis and epoch duration, used to compute the current epoch from the time
+GENESIS_TIMESTAMP = 1598306400
+EPOCH_DURATION = 30
+
 #################################################################################
 # CLASS DEFINITION
 #################################################################################
@@ -123,12 +146,149 @@ class DaemonError(Error):
 class BoostError(Error):
     """Customer Exception to identify error coming from boost. Used  for the dashboard Status panel"""
 
+class RpcStats():
+    """ Statistics of the API calls recorded by the transport layer, per target and method : number of calls, errors,
+    response bytes and latency histogram. They are cumulated since the start of the process and exported by Metrics at the
+    end of each scrape"""
+
+    # Upper bounds of the latency histogram buckets in seconds
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    # {(target, method): [calls, errors, response bytes, total seconds, [calls per bucket]]}
+    __stats = {}
+    __lock = threading.Lock()
+
+    # Totals since the start of the process, never reset
+    total_calls = 0
+    total_bytes = 0
+
+    @classmethod
+    def record(cls, target, method, seconds, size=0, error=False):
+        """ record one API call"""
+        with cls.__lock:
+            try:
+                stats = cls.__stats[(target, method)]
+            except KeyError:
+                stats = cls.__stats[(target, method)] = [0, 0, 0, 0.0, [0] * len(cls.buckets)]
+            stats[0] += 1
+            stats[1] += int(error)
+            stats[2] += size
+            stats[3] += seconds
+            cls.total_calls += 1
+            cls.total_bytes += size
+            for index, bound in enumerate(cls.buckets):
+                if seconds <= bound:
+                    stats[4][index] += 1
+                    break
+
+    @classmethod
+    def export(cls, metrics):
+        """ add the statistics recorded since the start of the process to metrics"""
+        with cls.__lock:
+            stats = {key: (calls, errors, size, seconds, list(counts)) for key, (calls, errors, size, seconds, counts) in cls.__stats.items()}
+
+        for (target, method), (calls, errors, size, seconds, counts) in sorted(stats.items()):
+            metrics.add("rpc_requests", value=calls, target=target, method=method)
+            metrics.add("rpc_errors", value=errors, target=target, method=method)
+            metrics.add("rpc_response_bytes", value=size, target=target, method=method)
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(cls.buckets, counts):
+                cumulative += count
+                buckets.append((bound, cumulative))
+            metrics.add_histogram("rpc_duration_seconds", buckets, seconds, calls, target=target, method=method)
+
+
+class RpcCapture():
+    """ Record the API calls (JSON-RPC and graphql) with their raw responses and latencies to a gzip JSON lines file, and
+    replay them instead of calling the nodes. The first line of the file is a header with the connection settings of
+    the config, without the tokens. Replayed calls are matched on target, method and params and delayed by their
+    recorded latency multiplied by speed (0 disables the delays). The last response of a call is replayed again if the
+    call is made more times than recorded"""
+
+    config_keys = ["miner_api", "markets_api", "daemon_api", "boost_api", "boost_graphql", "markets_type"]
+
+    recording = False
+    replaying = False
+    config = {}
+    __file = None
+    __lock = threading.Lock()
+    __calls = {}
+    __speed = 1
+
+    @classmethod
+    def start_recording(cls, file_name, config):
+        """ record the calls to file_name"""
+        cls.__file = gzip.open(file_name, "wt")
+        settings = cls.connection_settings(config)
+        settings["miners"] = [cls.connection_settings(miner) for miner in config.get("miners", [])]
+        cls.__file.write(json.dumps({"version": 1, "exporter": VERSION, "date": time.time(), "config": settings}) + "\n")
+        cls.recording = True
+        atexit.register(cls.stop)
+
+    @classmethod
+    def connection_settings(cls, config):
+        """ return the connection settings of config without the API tokens"""
+        settings = {key: config[key] for key in cls.config_keys if key in config}
+        for key in settings:
+            if key.endswith("_api"):
+                settings[key] = "replay:" + settings[key].split(":", 1)[-1]
+        return settings
+
+    @classmethod
+    def record(cls, target, method, params, response, latency, error=None):
+        """ record one call, response is the raw response"""
+        line = json.dumps({"target": target, "method": method, "params": params, "latency": latency, "response": response, "error": error})
+        with cls.__lock:
+            cls.__file.write(line + "\n")
+
+    @classmethod
+    def stop(cls):
+        """ close the capture file"""
+        if cls.__file is not None:
+            cls.__file.close()
+            cls.__file = None
+        cls.recording = False
+
+    @classmethod
+    def start_replay(cls, file_name, speed=1):
+        """ load the capture file_name, the following calls are served from it"""
+        with gzip.open(file_name, "rt") as f:
+            cls.config = json.loads(f.readline())["config"]
+            for line in f:
+                call = json.loads(line)
+                key = (call["target"], call["method"], json.dumps(call["params"], sort_keys=True))
+                cls.__calls.setdefault(key, collections.deque()).append((call["latency"], call["response"], call["error"]))
+        cls.__speed = speed
+        cls.replaying = True
+
+    @classmethod
+    async def replay(cls, target, method, params):
+        """ return the raw response of a recorded call after its recorded latency. Raise the recorded connection errors"""
+        calls = cls.__calls.get((target, method, json.dumps(params, sort_keys=True)))
+        if not calls:
+            logging.warning(f"replay : no {target} {method} call with params {params} in the capture")
+            return json.dumps({"jsonrpc": "2.0", "id": 3, "error": {"code": -32601, "message": "call not found in the capture"}})
+
+        latency, response, error = calls.popleft() if len(calls) > 1 else calls[0]
+        if cls.__speed:
+            await asyncio.sleep(latency * cls.__speed)
+        if error is not None:
+            raise ConnectionError(error)
+        return response
 
 class Lotus():
     """Lotus class is a common parent class to Miner and Daemon Class"""
     target = "lotus"
     Error = Error
 
+    # Event loop running in a background thread and HTTP session shared by all the nodes : connections are kept alive
+    # between calls and scrapes, and the miners of a multi-miner scrape use the same connection pool
+    __loop = None
+    __loop_thread = None
+    __loop_lock = threading.Lock()
+    __session = None
+
     actor_type = {
         "system":           "System",
         "init":             "Init",
@@ -348,27 +508,80 @@ class Lotus():
         return result
 
     @Error.wrap
-    def get_multiple(self, requests):
-        """ Send multiple request in Async mode to the daemon API"""
-        return asyncio.run(self.__get_json_multiple(self.url, self.token, requests))
+    def get_multiple(self, requests, raw=False):
+        """ Send multiple request in Async mode to the daemon API. With raw, the undecoded response bodies are returned"""
+        return self.run_async(self.__get_json_multiple(self.url, self.token, requests, raw))
+
+    @staticmethod
+    def run_async(coroutine):
+        """ run the coroutine on the shared event loop, started in a background thread on first use, and return its result.
+        Can be called from any thread"""
+        with Lotus.__loop_lock:
+            if Lotus.__loop is None:
+                Lotus.__loop = asyncio.new_event_loop()
+                Lotus.__loop_thread = threading.Thread(target=Lotus.__loop.run_forever, name="asyncio", daemon=True)
+                Lotus.__loop_thread.start()
+                atexit.register(Lotus.close)
+        return asyncio.run_coroutine_threadsafe(coroutine, Lotus.__loop).result()
+
+    @staticmethod
+    def loop_thread_id():
+        """ return the thread id of the shared event loop, None if it is not started"""
+        return Lotus.__loop_thread.ident if Lotus.__loop_thread is not None else None
+
+    @staticmethod
+    def close():
+        """ close the shared HTTP session"""
+        async def close_session():
+            if Lotus.__session is not None:
+                await Lotus.__session.close()
+                Lotus.__session = None
+        if Lotus.__loop is not None:
+            asyncio.run_coroutine_threadsafe(close_session(), Lotus.__loop).result()
 
     @classmethod
-    async def __get_json_multiple(cls, url, token, requests):
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            for request in requests:
-                tasks.append(asyncio.ensure_future(cls.__get_json(session, url, token, request)))
-            return await asyncio.gather(*tasks)
+    async def __get_json_multiple(cls, url, token, requests, raw=False):
+        # The session is only used from the event loop thread
+        if Lotus.__session is None:
+            import aiohttp
+            Lotus.__session = aiohttp.ClientSession()
+        tasks = []
+        for request in requests:
+            tasks.append(asyncio.ensure_future(cls.__get_json(Lotus.__session, url, token, request, cls.target, raw)))
+        return await asyncio.gather(*tasks)
 
     @staticmethod
-    async def __get_json(session, url, token, request):
+    async def __get_json(session, url, token, request, target, raw=False):
         header = {'Authorization': 'Bearer ' + token}
         method = request[0]
         params = request[1]
         jsondata = {"jsonrpc": "2.0", "method": "Filecoin." + method, "params": params, "id": 3}
 
-        async with session.post(url, json=jsondata, headers=header) as response:
-            return await response.json(content_type=None)
+        # Latency includes the connection (DNS, TCP) and the transfer of the response
+        start = time.perf_counter()
+        try:
+            if RpcCapture.replaying:
+                body = (await RpcCapture.replay(target, method, params)).encode()
+            else:
+                async with session.post(url, json=jsondata, headers=header) as response:
+                    body = await response.read()
+        except Exception as exp:
+            RpcStats.record(target, method, time.perf_counter() - start, error=True)
+            if RpcCapture.recording:
+                RpcCapture.record(target, method, params, None, time.perf_counter() - start, error=str(exp))
+            raise
+
+        if raw:
+            # The body is decoded by the caller. The error member of a JSON-RPC response follows the id, at its beginning
+            result = body
+            error = not body or b'"error"' in body[:64]
+        else:
+            result = json.loads(body) if body else None
+            error = not isinstance(result, dict) or "error" in result
+        RpcStats.record(target, method, time.perf_counter() - start, len(body), error=error)
+        if RpcCapture.recording:
+            RpcCapture.record(target, method, params, body.decode(), time.perf_counter() - start)
+        return result
 
     @staticmethod
     def bitfield_count(bitfield):
@@ -419,6 +632,16 @@ class Lotus():
             sector_id += bitfield[i + 1]
         return target, count
 
+    @staticmethod
+    def bitfield_iter(bitfield):
+        """ Iterate over the sector ids set in a golang Bitfield object"""
+
+        sector_id = 0
+        for i in range(0, len(bitfield) - 1, 2):
+            sector_id += bitfield[i]
+            yield from range(sector_id, sector_id + bitfield[i + 1])
+            sector_id += bitfield[i + 1]
+
     @staticmethod
     def qa_power_for_weight(size, duration, deal_weight, verified_weight):
         """ Calculate the Quality adjusted power of a sector based on deals weight.
@@ -452,13 +675,78 @@ class Daemon(Lotus):
     __local_wallet_list = None
     actor_cid = {}
 
+    # Actor code CIDs only change with the network version. They are kept in actor_cid_file (set by run()) :
+    # {"network_version": last version seen, "actor_cids": {version: {cid: actor}}}, and verified lazily : they are
+    # retrieved again when the Daemon collector sees a new network version or when an actor code is unknown
+    actor_cid_file = None
+    network_version = None
+    __actor_cid_verified = False
+    __actor_cid_lock = threading.Lock()
+
+    # Results of the calls that only depend on the chain head, shared by the miners of the daemon and kept between the
+    # scrapes of the same tipset : {(url, method, params): result}
+    __tipset = None
+    __tipset_results = {}
+    __tipset_lock = threading.Lock()
+
     @Error.wrap
     def __init__(self, url, token):
         self.url = url
         self.token = token
-        self.network_version = self.get("StateNetworkVersion", [self.tipset_key()])["result"]
-        for actor, cid in self.get("StateActorCodeCIDs", [self.network_version])["result"].items():
-            self.actor_cid[cid["/"]] = actor
+        with Daemon.__actor_cid_lock:
+            loaded = Daemon.network_version is not None or Daemon.load_actor_cids()
+        if not loaded:
+            self.refresh_actor_cids()
+
+    @staticmethod
+    def load_actor_cids():
+        """ load the actor code CIDs of the last network version from actor_cid_file, return False if there are none.
+        The file is not used when recording or replaying a capture, the captured calls are used instead"""
+        if Daemon.actor_cid_file is None or RpcCapture.recording or RpcCapture.replaying:
+            return False
+        try:
+            with open(Daemon.actor_cid_file, encoding="utf-8") as cache_file:
+                cache = json.load(cache_file)
+            network_version = cache["network_version"]
+            Daemon.actor_cid.update(cache["actor_cids"][str(network_version)])
+        except FileNotFoundError:
+            return False
+        except Exception as exp:
+            logging.warning(f"ignoring actor code cache {Daemon.actor_cid_file} : {exp}")
+            return False
+        Daemon.network_version = network_version
+        return True
+
+    @Error.wrap
+    def refresh_actor_cids(self, network_version=None):
+        """ retrieve the actor code CIDs of the network version (default : current one) and store them in actor_cid_file"""
+        if network_version is None:
+            network_version = self.get_tipset("StateNetworkVersion", [self.tipset_key()])["result"]
+        actor_cids = {cid["/"]: actor for actor, cid in self.get("StateActorCodeCIDs", [network_version])["result"].items()}
+
+        with Daemon.__actor_cid_lock:
+            Daemon.actor_cid.update(actor_cids)
+            Daemon.network_version = network_version
+            Daemon.__actor_cid_verified = True
+            if Daemon.actor_cid_file is None or RpcCapture.replaying:
+                return
+            try:
+                with open(Daemon.actor_cid_file, encoding="utf-8") as cache_file:
+                    cache = json.load(cache_file)
+            except Exception:
+                cache = {"actor_cids": {}}
+            cache["network_version"] = network_version
+            cache["actor_cids"][str(network_version)] = actor_cids
+            try:
+                write_file(Daemon.actor_cid_file, json.dumps(cache, indent=4, sort_keys=True).encode())
+            except Exception as exp:
+                logging.warning(f"cannot write actor code cache {Daemon.actor_cid_file} : {exp}")
+
+    def check_network_version(self, network_version):
+        """ retrieve the actor code CIDs again if the network version changed since they were loaded"""
+        if network_version != Daemon.network_version:
+            logging.info(f"network version {network_version}, retrieving the actor code CIDs")
+            self.refresh_actor_cids(network_version)
 
     @Error.wrap
     def chain_head(self):
@@ -472,6 +760,24 @@ class Daemon(Lotus):
         """ Return  tipset_key """
         return self.chain_head()["Cids"]
 
+    def get_tipset(self, method, params):
+        """ self.get(method, params) for a call whose result only depends on the chain head tipset. The result is
+        retrieved once per tipset"""
+        tipset = self.tipset_key()
+        key = (self.url, method, json.dumps(params))
+        with Daemon.__tipset_lock:
+            if Daemon.__tipset != tipset:
+                Daemon.__tipset = tipset
+                Daemon.__tipset_results = {}
+            if key in Daemon.__tipset_results:
+                return Daemon.__tipset_results[key]
+
+        result = self.get(method, params)
+        with Daemon.__tipset_lock:
+            if Daemon.__tipset == tipset:
+                Daemon.__tipset_results[key] = result
+        return result
+
     @Error.wrap
     def basefee(self):
         """ Return basefee """
@@ -484,6 +790,9 @@ class Daemon(Lotus):
 
     @Error.wrap
     def _get_actor_type(self, actor_code):
+        # An unknown actor code can come from stale cached CIDs, they are verified once against the daemon
+        if actor_code not in self.actor_cid and not Daemon.__actor_cid_verified:
+            self.refresh_actor_cids()
         try:
             a_type = self.actor_cid[actor_code]
         except Exception:
@@ -570,8 +879,9 @@ class Daemon(Lotus):
         return(actor_type, message_type)
 
     @Error.wrap
-    def get_deadlines_enhanced(self, miner_id):
+    def get_deadlines_enhanced(self, miner_id, sector_table=None):
         """ Merge StateMinerDeadlines StateMinerDeadlines into an unique object with the list of sectors per deadline instead of the bitfield
+        If a SectorTable is given, the partition and state of each sector are stored in the table and partitions are left empty.
         Structure is :
                 {
                     "Challenge": 480557,
@@ -636,6 +946,13 @@ class Daemon(Lotus):
                 deadlines_info["deadlines"][dl_id]["ProvenPartition"] = self.bitfield_count(proven_deadlines["result"][dl_id]["PostSubmissions"])
                 deadlines_info["deadlines"][dl_id]["partitions"] = {}
                 for partition_id, partition in enumerate(partitions["result"]):
+                    if sector_table is not None:
+                        for state, flag in Sector.partition_flags.items():
+                            count, added = sector_table.add_partition_bitfield(partition[f"{state}Sectors"], flag, dl_id, partition_id)
+                            deadlines_info["deadlines"][dl_id][f"{state}SectorsCount"] += count
+                            deadlines_info["deadlines"][dl_id]["AllSectorsCount"] += added
+                        continue
+
                     part = {}
                     part, count = self.bitfield_to_dict(partition["FaultySectors"], "Faulty", part)
                     deadlines_info["deadlines"][dl_id]["FaultySectorsCount"] += count
@@ -651,6 +968,28 @@ class Daemon(Lotus):
 
         return deadlines_info
 
+    @Error.wrap
+    def get_miner_sectors_enhanced(self, miner_id):
+        """ Return the on-chain information of all the sectors of the miner in one StateMinerSectors call, indexed by sector number
+        Structure is :
+                {
+                    25: {
+                        "SectorNumber": 25,
+                        "DealIDs": [ 1234 ],
+                        "Activation": 480557,
+                        "Expiration": 2035757,
+                        "DealWeight": "0",
+                        "VerifiedDealWeight": "1099511627776",
+                        [...]
+                    },
+                    [...]
+            """
+
+        res = {}
+        for sector in self.get("StateMinerSectors", [miner_id, None, self.tipset_key()])["result"] or []:
+            res[sector["SectorNumber"]] = sector
+        return res
+
     @Error.wrap
     def get_deal_info_enhanced(self, deal_id):
         """ Return deald information with lookup on addresses."""
@@ -773,12 +1112,25 @@ class Daemon(Lotus):
         wallet_list = self.get_wallet_list_enhanced(miner_id).keys()
         return self.get_mpool_pending_enhanced(wallet_list)
 
+class ChainWatcher(Lotus):
+    """ Lightweight daemon client used between scrapes to observe the chain head, without the initialisation of Daemon"""
+    target = "daemon"
+    Error = DaemonError
+
+    @Error.wrap
+    def height(self):
+        """ return the height of the chain head"""
+        return self.get("ChainHead", [])["result"]["Height"]
+
 class Miner(Lotus):
     """ Miner class"""
     target = "miner"
     Error = MinerError
     miner_id = None
 
+    # Long-term sector states, sectors in these states are fully described by their on-chain information
+    onchain_states = ["Proving", "Available"]
+
     @Error.wrap
     def id(self):
         """ return miner ID"""
@@ -787,6 +1139,15 @@ class Miner(Lotus):
             self.miner_id = actoraddress['result']
         return self.miner_id
 
+    @Error.wrap
+    def get_sectors_in_states(self, states):
+        """ Return the state of the sectors in the given states as a dict {sector_number: state} using one SectorsListInStates call per state"""
+        res = {}
+        for state in states:
+            for sector in self.get("SectorsListInStates", [[state]])["result"] or []:
+                res[sector] = state
+        return res
+
     @Error.wrap
     def get_storagelist_enhanced(self):
         """ Get storage list enhanced with reverse hostname lookup"""
@@ -875,10 +1236,11 @@ class Boost(Markets):
         self.graphql_url = graphql_url
 
         #Disable graphql log , to verbose by default
-        aiohttp_logger.setLevel(logging.WARNING)
+        logging.getLogger("gql.transport.aiohttp").setLevel(logging.WARNING)
 
     @Error.wrap
     def get_pending_publish_deals(self):
+        from gql import gql
         query = gql("query { dealPublish { Start Period Deals { PieceSize ClientAddress StartEpoch EndEpoch ProviderCollateral ID } } }")
         result = self.get_graphql(query)
         return result
@@ -886,14 +1248,224 @@ class Boost(Markets):
     @Error.wrap
     def get_graphql(self, query):
         """Send a graphql query to boost, this function is not async yet"""
+        from gql import Client
+        from gql.transport.aiohttp import AIOHTTPTransport
 
         transport = AIOHTTPTransport(url=self.graphql_url)
         client = Client(transport=transport, fetch_schema_from_transport=False)
 
-        result = client.execute(query)
+        # The method of a graphql query is its first field. gql >= 4 wraps the document in a GraphQLRequest
+        document = getattr(query, "document", query)
+        method = document.definitions[0].selection_set.selections[0].name.value
+        start = time.perf_counter()
+        try:
+            if RpcCapture.replaying:
+                result = json.loads(Lotus.run_async(RpcCapture.replay("boost_graphql", method, None)))
+            else:
+                result = client.execute(query)
+        except Exception as exp:
+            RpcStats.record("boost_graphql", method, time.perf_counter() - start, error=True)
+            if RpcCapture.recording:
+                RpcCapture.record("boost_graphql", method, None, None, time.perf_counter() - start, error=str(exp))
+            raise
+        response = json.dumps(result)
+        RpcStats.record("boost_graphql", method, time.perf_counter() - start, len(response))
+        if RpcCapture.recording:
+            RpcCapture.record("boost_graphql", method, None, response, time.perf_counter() - start)
 
         return result
 
+class Sector():
+    """ Compact record of a sector. Uses __slots__ to avoid one dict per sector as miners can have millions of sectors"""
+
+    __slots__ = ("sector_id", "state", "to_upgrade", "pledged", "deals", "deal_ids", "deal_weight", "verified_weight", "qa_power",
+                 "creation_date", "packed_date", "finalized_date", "deadline_id", "partition_id", "flags")
+
+    # Partition states of the sector, stored as bits in flags
+    partition_flags = {"Faulty": 1, "Recovering": 2, "Active": 4, "Live": 8}
+
+    def __init__(self, sector_id):
+        self.sector_id = sector_id
+        self.state = None
+        self.to_upgrade = False
+        self.pledged = 1
+        self.deals = 0
+        self.deal_ids = ()
+        self.deal_weight = 0
+        self.verified_weight = 0
+        self.qa_power = 0
+        self.creation_date = ""
+        self.packed_date = ""
+        self.finalized_date = ""
+        self.deadline_id = None
+        self.partition_id = None
+        self.flags = 0
+
+    def set_deals(self, size, deal_ids, activation, expiration, deal_weight, verified_weight):
+        """ Set the number of deals, deals weight and the quality adjusted power of the sector. The state must be set first"""
+        self.deals = len(deal_ids) - deal_ids.count(0)
+        self.qa_power = size
+
+        if self.deals > 0 and self.state != "Removed":
+            duration = int(expiration) - int(activation)
+            self.verified_weight = int(verified_weight)
+            self.deal_weight = int(deal_weight)
+            self.qa_power = Lotus.qa_power_for_weight(size, duration, self.deal_weight, self.verified_weight)
+
+        # deal ids are only kept for sealing sectors, they are used to lookup the deals information
+        if self.state not in ["Proving", "Removed"]:
+            self.deal_ids = tuple(deal for deal in deal_ids if deal != 0)
+
+    def set_log(self, log):
+        """ Set the sector events and pledged status based on the SectorsStatus log"""
+        try:
+            self.creation_date = log[0]["Timestamp"]
+        except Exception as exp:
+            logging.warning(f"Sector {self.sector_id} : cannot find sector creation date : {exp}")
+            self.creation_date = 0
+
+        for entry in log:
+            if entry["Kind"] == "event;sealing.SectorPacked":
+                self.packed_date = entry["Timestamp"]
+            elif entry["Kind"] == "event;sealing.SectorFinalized":
+                self.finalized_date = entry["Timestamp"]
+
+        try:
+            if log[0]["Kind"] == "event;sealing.SectorStartCC":
+                self.pledged = 1
+            else:
+                self.pledged = 0
+        except Exception as exp:
+            logging.warning(f"Sector {self.sector_id} : cannot find sector kind, default to CC : {exp}")
+            self.pledged = 1
+
+    def is_in_partition(self, flag):
+        """ return True if the sector has the given partition state"""
+        return self.flags & flag != 0
+
+class SectorTable():
+    """ In-memory table of the sectors of a miner indexed by sector number. Raw json responses are converted to Sector records
+    as soon as they are received, so they can be released"""
+
+    # Number of SectorsStatus requests sent and decoded at once
+    batch_size = 1000
+
+    # Worker processes decoding the SectorsStatus responses (sectors_processes), shared by the miners and kept between
+    # the scrapes
+    __pool = None
+    __pool_size = 0
+    __pool_lock = threading.Lock()
+
+    def __init__(self):
+        self.__sectors = {}
+
+    def __len__(self):
+        return len(self.__sectors)
+
+    def __iter__(self):
+        return iter(self.__sectors.values())
+
+    def __contains__(self, sector_id):
+        return sector_id in self.__sectors
+
+    def get(self, sector_id):
+        """ return the sector record, create it if it doesn't exist"""
+        try:
+            return self.__sectors[sector_id]
+        except KeyError:
+            sector = self.__sectors[sector_id] = Sector(sector_id)
+            return sector
+
+    def add_status(self, sector_id, status, size):
+        """ Add a sector from a SectorsStatus result"""
+        sector = self.get(sector_id)
+        sector.state = status["State"]
+        sector.to_upgrade = status["ToUpgrade"]
+        sector.set_deals(size, status["Deals"], status["Activation"], status["Expiration"], status["DealWeight"], status["VerifiedDealWeight"])
+        sector.set_log(status["Log"])
+        return sector
+
+    def add_onchain(self, sector_id, state, onchain, size):
+        """ Add a sector from a StateMinerSectors result. There is no sealing log, a sector without deals is considered pledged"""
+        sector = self.get(sector_id)
+        sector.state = state
+        sector.set_deals(size, onchain["DealIDs"] or [], onchain["Activation"], onchain["Expiration"], onchain["DealWeight"], onchain["VerifiedDealWeight"])
+        sector.pledged = 0 if sector.deals > 0 else 1
+        return sector
+
+    def load_status(self, miner, sector_ids, size):
+        """ Retrieve SectorsStatus of the sectors by batch of batch_size requests in ASYNC mode and add them to the table"""
+        sector_ids = list(sector_ids)
+        for start in range(0, len(sector_ids), self.batch_size):
+            batch = sector_ids[start:start + self.batch_size]
+            details = miner.get_multiple([["SectorsStatus", [sector_id, True]] for sector_id in batch])
+            for sector_id, detail in zip(batch, details):
+                self.add_status(sector_id, detail["result"], size)
+
+    @staticmethod
+    def process_pool(processes):
+        """ return the pool of worker processes, created on first use. None if processes is 0"""
+        if processes <= 0:
+            return None
+        with SectorTable.__pool_lock:
+            if SectorTable.__pool is None:
+                import concurrent.futures
+                import multiprocessing
+
+                # Workers are spawned : forking would copy the threads of the exporter (event loop, http server)
+                SectorTable.__pool = concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"))
+                SectorTable.__pool_size = processes
+        return SectorTable.__pool
+
+    def process_status(self, miner, sector_ids, size, miner_id, pool, fmt="prometheus"):
+        """ Retrieve SectorsStatus of the sectors by batch of batch_size requests, decode and render them in the worker
+        processes of the pool while the next batches are retrieved. Yield the results of render_status in the order of the batches"""
+        sector_ids = list(sector_ids)
+        pending = collections.deque()
+        for start in range(0, len(sector_ids), self.batch_size):
+            batch = sector_ids[start:start + self.batch_size]
+            bodies = miner.get_multiple([["SectorsStatus", [sector_id, True]] for sector_id in batch], raw=True)
+            pending.append(pool.submit(SectorTable.render_status, bodies, batch, size, miner_id, fmt))
+            # Bound the number of batches waiting in memory
+            while len(pending) > 2 * SectorTable.__pool_size or (pending and pending[0].done()):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    @staticmethod
+    def render_status(bodies, sector_ids, size, miner_id, fmt="prometheus"):
+        """ Decode raw SectorsStatus responses and return (rendered samples of the sectors {family: (samples, lines)},
+        [(sector id, deal ids)] of the sealing sectors with deals). Executed in the worker processes"""
+        table = SectorTable()
+        for sector_id, body in zip(sector_ids, bodies):
+            detail = json.loads(body) if body else None
+            if detail is None or "error" in detail:
+                raise MinerError(f"\nTarget : miner\nMethod : SectorsStatus\nParams : {[sector_id, True]}\nResult : {detail}")
+            table.add_status(sector_id, detail["result"], size)
+
+        samples = RenderedFragment(fmt)
+        deals = []
+        for sector in table:
+            add_sector_samples(samples, sector, miner_id)
+            if sector.deal_ids:
+                deals.append((sector.sector_id, sector.deal_ids))
+        return samples.families, deals
+
+    def add_partition_bitfield(self, bitfield, flag, deadline_id, partition_id):
+        """ Flag the sectors of a golang Bitfield as members of the partition.
+        return the number of sectors in the bitfield and the number of sectors not already seen in this partition"""
+        count = 0
+        added = 0
+        for sector_id in Lotus.bitfield_iter(bitfield):
+            sector = self.get(sector_id)
+            if sector.deadline_id != deadline_id or sector.partition_id != partition_id:
+                sector.deadline_id = deadline_id
+                sector.partition_id = partition_id
+                sector.flags = 0
+                added += 1
+            sector.flags |= flag
+            count += 1
+        return count, added
 
 class Metrics():
     """ This class manage prometheus metrics formatting / checking / print """
@@ -961,20 +1533,90 @@ class Metrics():
         "net_total_out"                             : {"type" : "counter", "help": "return output net"},
         "power"                                     : {"type" : "gauge", "help": "return miner power"},
         "power_mining_eligibility"                  : {"type" : "gauge", "help": "return miner mining eligibility"},
+        "process_startup_seconds"                   : {"type" : "gauge", "help": "time spent starting the exporter (imports, configuration) before its first scrape"},
+        "remote_write_samples"                      : {"type" : "counter", "help": "number of samples pushed to the remote write endpoint per status (sent, failed, dropped)"},
+        "rpc_duration_seconds"                      : {"type" : "histogram", "help": "latency of the API calls since the start of the exporter per target and method"},
+        "rpc_errors"                                : {"type" : "counter", "help": "number of API calls since the start of the exporter that failed or returned an error per target and method"},
+        "rpc_requests"                              : {"type" : "counter", "help": "number of API calls since the start of the exporter per target and method"},
+        "rpc_response_bytes"                        : {"type" : "counter", "help": "size of the API responses since the start of the exporter per target and method"},
+        "scrape_collector_age_seconds"              : {"type" : "gauge", "help": "age of the samples of the collector, time since its last successful refresh"},
+        "scrape_collector_success"                  : {"type" : "gauge", "help": "1 if the last refresh of the collector succeeded, 0 if it failed and the samples of its last successful refresh are exported"},
         "scrape_duration_seconds"                   : {"type" : "gauge", "help": "execution time of the different collectors"},
         "scrape_execution_succeed"                  : {"type" : "gauge", "help": "return 1 if lotus-farcaster execution was successfully"},
+        "scrape_series_dropped"                     : {"type" : "gauge", "help": "number of series of the family dropped or aggregated because of its series budget"},
+        "scrape_series_emitted"                     : {"type" : "gauge", "help": "number of series of the family in the exposition"},
         "wallet_balance"                            : {"type" : "gauge", "help": "return wallet balance"},
         "wallet_locked_balance"                     : {"type" : "gauge", "help": "return miner wallet locked funds"},
         "wallet_verified_datacap"                   : {"type" : "gauge", "help": "return miner wallet datacap per address"}
     }
 
-    __metrics = []
+    # Series budget of the high cardinality families. When a family reaches its limit, the overflow policy applies :
+    #   aggregate : series over the limit are summed into one series per value of the "by" labels, with label overflow="true"
+    #   top       : keep the limit series with the highest values
+    #   sample    : keep a stable sample of limit series, the same label sets are kept from one scrape to another
+    # drop_labels removes high churn labels from the family. Budgets can be overridden in config.toml [metrics_budget.<family>]
+    __METRICS_BUDGET = {
+        "miner_deadline_active_partition_sector"    : {"limit": 1000000, "policy": "sample"},
+        "miner_sector_event"                        : {"limit": 3000000, "policy": "sample"},
+        "miner_sector_qa_power"                     : {"limit": 1000000, "policy": "aggregate", "by": ["miner_id"]},
+        "miner_sector_state"                        : {"limit": 1000000, "policy": "aggregate", "by": ["miner_id", "state"]},
+        "miner_sector_weight"                       : {"limit": 2000000, "policy": "aggregate", "by": ["miner_id", "weight_type"]},
+        "miner_worker_job"                          : {"limit": 10000, "policy": "top", "drop_labels": []}
+    }
+
+    __BUDGET_POLICIES = ["aggregate", "top", "sample"]
+
+    # Number of samples written to the output at once
+    __WRITE_CHUNK_SIZE = 10000
 
-    def __init__(self, output=sys.stdout):
+    # Startup time of the process, measured at the beginning of its first scrape
+    startup_seconds = None
+
+    # Supported exposition formats and their content type
+    content_types = {
+        "prometheus":   "text/plain; version=0.0.4; charset=utf-8",
+        "openmetrics":  "application/openmetrics-text; version=1.0.0; charset=utf-8"
+    }
+
+    def __init__(self, output=sys.stdout, fmt="prometheus", budgets=None, render_cache=None, remote_write=None, profiler=None):
         self.__start_time = time.time()
         self.__last_collector_start_time = self.__start_time
         self._output = output
+        self.fmt = fmt
+        self.__openmetrics = fmt == "openmetrics"
+        self.__render_cache = render_cache
+        self.__remote_write = remote_write
+        self.__profiler = profiler
+
+        # Series budgets : defaults overridden by the configuration
+        self.__budgets = {}
+        for m_name, budget in list(self.__METRICS_BUDGET.items()) + list((budgets or {}).items()):
+            if m_name not in self.__METRICS_LIST:
+                raise Exception(f'metrics_budget : metric "{m_name}" undefined in __METRICS_LIST')
+            budget = {"by": [], "drop_labels": [], **self.__budgets.get(m_name, {}), **budget}
+            if budget.get("policy") not in self.__BUDGET_POLICIES:
+                raise Exception(f'metrics_budget : unknown policy "{budget.get("policy")}" for metric "{m_name}"')
+            self.__budgets[m_name] = budget
+
+        # Samples are grouped by family as they are added : {name: [(key, value), ...]}
+        # the key of a series is (label names, escaped label values), label names tuples are shared by all the series with the same labels
+        # values are kept rendered as strings : two samples compare equal only if their exposition lines are identical
+        # Families with a top or sample budget that reached their limit become heaps of (sort key, position, key, value) until
+        # the budget is applied : {name} in __heaps
+        self.__families = {}
+        self.__heaps = set()
+        # Lines of the samples rendered by the worker processes (add_rendered) : {name: [(position in the family, lines), ...]}
+        self.__rendered = {}
+        self.__label_names = {}
+        self.__templates = {}
+        self.__added = {}
+        self.__overflow = {}
+        self.__budgets_applied = False
+        self.__error = None
         self.add("local_time", value=int(self.__start_time))
+        if Metrics.startup_seconds is None:
+            Metrics.startup_seconds = round(self.__start_time - PROCESS_START_TIME, 6)
+        self.add("process_startup_seconds", value=Metrics.startup_seconds)
 
     def __enter__(self):
         return self
@@ -983,65 +1625,961 @@ class Metrics():
         self.add("scrape_duration_seconds", value=(time.time() - self.__start_time), collector="All")
 
         # GENERATE EXIT CODE AND PRINT OUTPUT
-        if exc_type is None:
+        # Errors of collectors exporting their last samples are reported without clearing the metrics
+        error_type = exc_type if exc_type is not None else self.__error
+        if error_type is None:
             success = 1
+        elif error_type == BoostError:
+            success = -4
+        elif error_type == MarketsError:
+            success = -3
+        elif error_type == MinerError:
+            success = -2
+        elif error_type == DaemonError:
+            success = -1
         else:
-            if exc_type == BoostError:
-                success = -4
-            elif exc_type == MarketsError:
-                success = -3
-            elif exc_type == MinerError:
-                success = -2
-            elif exc_type == DaemonError:
-                success = -1
-            elif exc_type is not None:
-                success = 0
+            success = 0
 
+        if exc_type is not None:
             # Clear the existing metrics list
-            self.__metrics = []
+            self.__families = {}
+            self.__heaps = set()
+            self.__rendered = {}
+            self.__added = {}
+            self.__overflow = {}
 
         self.add("scrape_execution_succeed", value=success)
+        RpcStats.export(self)
+        if self.__remote_write is not None:
+            for status, count in self.__remote_write.samples.items():
+                self.add("remote_write_samples", value=count, status=status)
         self.print_all()
+        if self.__profiler is not None:
+            self.__profiler.span("Exposition")
+
+        # Push the scrape to the remote write endpoint
+        if self.__remote_write is not None:
+            self.__remote_write.push(self)
+
+    def add_error(self, exp):
+        """ record the error of a collector that exported stale samples, scrape_execution_succeed reports the first one"""
+        if self.__error is None:
+            self.__error = type(exp)
+
+    @property
+    def start_time(self):
+        """ time of the beginning of the scrape, used as timestamp of the samples pushed by remote write"""
+        return self.__start_time
 
     def add(self, metric: str = "", value: float = 1, **labels):
         """ add a new metrics """
 
-        # Check if metric is in the list of the metrics allowed
-        if metric in self.__METRICS_LIST.keys():
-            self.__metrics.append({"name": metric, "labels": labels, "value": value})
+        try:
+            family = self.__families[metric]
+        except KeyError:
+            # Check if metric is in the list of the metrics allowed
+            if metric not in self.__METRICS_LIST.keys():
+                raise Exception(f'metric "{metric}" undefined in __METRICS_LIST')
+            family = self.__families[metric] = []
+
+        budget = self.__budgets.get(metric)
+        if budget is None:
+            family.append((self.series_key(labels), str(value)))
         else:
-            raise Exception(f'metric "{metric}" undefined in __METRICS_LIST')
+            self.__add_budgeted(metric, family, budget, value, labels)
+
+    def add_rendered(self, metric, samples, lines):
+        """ add samples rendered by another process with series_key and format_sample : samples is the list of (key, value)
+        and lines their exposition lines, used as is by print_all. When the samples would overflow the series budget of the
+        family or have labels to drop, they are added one by one"""
+        family = self.__families.get(metric)
+        budget = self.__budgets.get(metric)
+        drop_labels = budget["drop_labels"] if budget is not None else ()
+        if budget is not None and (metric in self.__heaps or len(family or ()) + len(samples) > budget["limit"]
+                                   or drop_labels and any(label in names for names in {key[0] for key, _ in samples} for label in drop_labels)):
+            unescape = RemoteWrite.unescape
+            for (names, values), value in samples:
+                self.add(metric, value, **dict(zip(names, [unescape(label) for label in values])))
+            return
+
+        if family is None:
+            if metric not in self.__METRICS_LIST.keys():
+                raise Exception(f'metric "{metric}" undefined in __METRICS_LIST')
+            family = self.__families[metric] = []
+        if budget is not None:
+            self.__added[metric] = self.__added.get(metric, 0) + len(samples)
+        self.__rendered.setdefault(metric, []).append((len(family), lines))
+        family.extend(samples)
+
+    def add_histogram(self, metric, buckets, total, count, **labels):
+        """ add a series of a histogram. buckets is the list of (upper bound, cumulative count). The _bucket, _count and _sum
+        samples of the series are stored as one value : ((le, count) of the buckets, count, sum)"""
+        try:
+            family = self.__families[metric]
+        except KeyError:
+            if self.__METRICS_LIST.get(metric, {}).get("type") != "histogram":
+                raise Exception(f'histogram "{metric}" undefined in __METRICS_LIST')
+            family = self.__families[metric] = []
+
+        buckets = tuple([(str(float(bound)), str(value)) for bound, value in buckets] + [("+Inf", str(count))])
+        family.append((self.series_key(labels), (buckets, str(count), str(total))))
+
+    def histogram_samples(self, metric, value, key):
+        """ return the samples of a histogram series as (sample name, key, value) : buckets, count then sum"""
+        names, values = key
+        le_names = self.__label_names.setdefault(names + ("le",), names + ("le",))
+        buckets, count, total = value
+        samples = [(f"{metric}_bucket", (le_names, values + (le,)), bucket_count) for le, bucket_count in buckets]
+        samples.append((f"{metric}_count", key, count))
+        samples.append((f"{metric}_sum", key, total))
+        return samples
+
+    def format_histogram(self, metric, value, key):
+        """ return the exposition lines of a histogram series, its samples follow each other as required by OpenMetrics"""
+        return "".join([self.format_sample(name, sample_value, sample_key) for name, sample_key, sample_value in self.histogram_samples(metric, value, key)])
+
+    def series_key(self, labels):
+        """ return the key of a series : (label names, escaped label values)"""
+        names = tuple(labels)
+        escape = self.escape
+        return (self.__label_names.setdefault(names, names), tuple([escape(label) for label in labels.values()]))
+
+    def format_sample(self, metric, value, key):
+        """ return the exposition line of a sample"""
+        names, values = key
+        try:
+            template = self.__templates[(metric, names)]
+        except KeyError:
+            template = self.__templates[(metric, names)] = self.__template(metric, names)
+        return template.format(*values, value)
+
+    def __template(self, metric, names):
+        """ return the str.format template of the exposition line for a family and a set of label names"""
+        if self.__openmetrics:
+            if not names:
+                return self.__PREFIX + metric + " {}\n"
+            return self.__PREFIX + metric + "{{" + ",".join([name + '="{}"' for name in names]) + "}} {}\n"
+        return self.__PREFIX + metric + " {{ " + ", ".join([name + '="{}"' for name in names]) + " }} {}\n"
+
+    def __add_budgeted(self, metric, family, budget, value, labels):
+        """ add a sample to a family with a series budget. The samples are kept in insertion order up to the limit, then top
+        and sample policies keep a bounded heap of the limit best series"""
+        for label in budget["drop_labels"]:
+            labels.pop(label, None)
+
+        self.__added[metric] = self.__added.get(metric, 0) + 1
+
+        if budget["policy"] == "aggregate":
+            if len(family) < budget["limit"]:
+                family.append((self.series_key(labels), str(value)))
+            else:
+                by_labels = {label: labels.get(label, "") for label in budget["by"]}
+                by_labels["overflow"] = "true"
+                by_key = (metric, self.series_key(by_labels))
+                self.__overflow[by_key] = self.__overflow.get(by_key, 0) + float(value)
+            return
+
+        key = self.series_key(labels)
+        if metric not in self.__heaps:
+            if len(family) < budget["limit"]:
+                family.append((key, str(value)))
+                return
+            if budget["limit"] <= 0:
+                return
+
+            # The limit is reached : the family becomes a heap. The position in the family restores the insertion order when the
+            # budget is applied and avoids comparing label values of different types. The positions of the lines rendered by
+            # the worker processes are lost, these samples are rendered again
+            self.__heaps.add(metric)
+            self.__rendered.pop(metric, None)
+            family[:] = [(self.__sort_key(budget, series, series_value), position, series, series_value) for position, (series, series_value) in enumerate(family)]
+            heapq.heapify(family)
+
+        heapq.heappushpop(family, (self.__sort_key(budget, key, value), self.__added[metric], key, str(value)))
+
+    @staticmethod
+    def __sort_key(budget, key, value):
+        """ sort key of a series in a top or sample heap : its value, or a hash of its label values for a stable sample"""
+        if budget["policy"] == "top":
+            return float(value)
+        return zlib.crc32("\0".join([str(label) for label in key[1]]).encode())
+
+    def apply_budgets(self):
+        """ finalize budgeted families, add aggregated overflow series and the number of series emitted and dropped per family"""
+        if self.__budgets_applied:
+            return
+        self.__budgets_applied = True
+
+        dropped = {}
+        for m_name, budget in self.__budgets.items():
+            if m_name in self.__families:
+                if m_name in self.__heaps:
+                    self.__families[m_name] = [(key, value) for _, _, key, value in sorted(self.__families[m_name], key=lambda item: item[1])]
+                dropped[m_name] = self.__added[m_name] - len(self.__families[m_name])
+
+        for (m_name, key), value in self.__overflow.items():
+            self.__families[m_name].append((key, str(value)))
+        self.__overflow = {}
+
+        for m_name in sorted(self.__families):
+            if m_name in ["scrape_series_emitted", "scrape_series_dropped"]:
+                continue
+            self.add("scrape_series_emitted", value=len(self.__families[m_name]), family=m_name)
+            self.add("scrape_series_dropped", value=dropped.get(m_name, 0), family=m_name)
+
+    @staticmethod
+    def escape(label):
+        """ escape backslash, double-quote and line feed in a label value"""
+        if label.__class__ is int:
+            return label
+        label = str(label)
+        if "\\" in label or '"' in label or "\n" in label:
+            label = label.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return label
+
+    def metric_type(self, m_name):
+        """ return the type of the metric family. In OpenMetrics, counter samples must end with _total, others are exposed as unknown"""
+        m_type = self.__METRICS_LIST[m_name]["type"]
+        if self.__openmetrics and m_type == "counter" and not m_name.endswith("_total"):
+            return "unknown"
+        return m_type
+
+    def series(self):
+        """ return all the series of the scrape as (metric name, label names, escaped label values, value)"""
+        self.apply_budgets()
+        for m_name in sorted(self.__families):
+            name = f"{self.__PREFIX}{m_name}"
+            if self.__METRICS_LIST[m_name]["type"] == "histogram":
+                for key, value in self.__families[m_name]:
+                    for sample_name, (names, values), sample_value in self.histogram_samples(m_name, value, key):
+                        yield (f"{self.__PREFIX}{sample_name}", names, values, sample_value)
+                continue
+            for (names, values), value in self.__families[m_name]:
+                yield (name, names, values, value)
 
     def print_all(self):
         """ printout all the metrics """
 
-        prev = {}
-        # go through all metrics in alphabetic order
-        for metric in sorted(self.__metrics, key=lambda m: m['name']):
-            m_name = metric["name"]
-
-            # Check if a the HELP and TYPE has already been displayed written
-            if prev == {} or m_name is not prev["name"]:
-                print(f'# HELP {self.__PREFIX}{ m_name } { self.__METRICS_LIST[m_name]["help"] }', file=self._output)
-                print(f'# TYPE {self.__PREFIX}{ m_name } { self.__METRICS_LIST[m_name]["type"] }', file=self._output)
-
-            # Printout the formatted metric
-            print(f'{self.__PREFIX}{ m_name } {{ ', end="", file=self._output)
-            first = True
-            for i in metric["labels"].keys():
-                if first is True:
-                    first = False
-                else:
-                    print(', ', end="", file=self._output)
-                print(f'{ i }="{ metric["labels"][i] }"', end="", file=self._output)
-            print(f' }} { metric["value"] }', file=self._output)
-            prev = metric
-
-    def checkpoint(self, collector_name):
+        self.apply_budgets()
+
+        # go through all metrics families in alphabetic order
+        for m_name in sorted(self.__families):
+            self._output.write(f'# HELP {self.__PREFIX}{ m_name } { self.__METRICS_LIST[m_name]["help"] }\n'
+                               f'# TYPE {self.__PREFIX}{ m_name } { self.metric_type(m_name) }\n')
+
+            # Write the rendered samples by large chunks
+            for chunk in self.__render_family(m_name, self.__families[m_name]):
+                self._output.write(chunk)
+
+        if self.__openmetrics:
+            self._output.write("# EOF\n")
+        self._output.flush()
+
+        # Evict the families that are not in this scrape from the render cache
+        if self.__render_cache is not None:
+            for m_name in list(self.__render_cache):
+                if m_name not in self.__families:
+                    del self.__render_cache[m_name]
+
+    def __render_family(self, m_name, samples):
+        """ return the exposition of the family as text chunks of __WRITE_CHUNK_SIZE samples. With a render cache, the rendered
+        line of each series is kept : only the new series and the series whose value changed since the previous scrape are
+        rendered again"""
+        size = self.__WRITE_CHUNK_SIZE
+        format_sample = self.format_histogram if self.__METRICS_LIST[m_name]["type"] == "histogram" else self.format_sample
+        if self.__render_cache is None and m_name not in self.__rendered:
+            return ["".join([format_sample(m_name, value, key) for key, value in samples[start:start + size]]) for start in range(0, len(samples), size)]
+
+        # Lines already rendered by the worker processes
+        lines = [None] * len(samples)
+        for start, rendered in self.__rendered.get(m_name, ()):
+            lines[start:start + len(rendered)] = rendered
+
+        if self.__render_cache is None:
+            for position, (key, value) in enumerate(samples):
+                if lines[position] is None:
+                    lines[position] = format_sample(m_name, value, key)
+            return ["".join(lines[start:start + size]) for start in range(0, len(lines), size)]
+
+        # The series are compared in order with the ones of the previous scrape by the hash of (label set, value). A series
+        # found at another position (series added or removed before it) is looked up by hash : {hash: position}, indexed on
+        # the first mismatch. A series not found is new or its value changed, its line is rendered again
+        hashes = array.array("q", map(hash, samples))
+        cached_hashes, cached_lines = self.__render_cache.get(m_name, ((), []))
+        cached_count = len(cached_hashes)
+        index = None
+        position = 0
+        for sample_position, sample_hash in enumerate(hashes):
+            if position >= cached_count or cached_hashes[position] != sample_hash:
+                if index is None:
+                    index = {cached_hash: cached_position for cached_position, cached_hash in enumerate(cached_hashes)}
+                cached_position = index.get(sample_hash)
+                if cached_position is None:
+                    if lines[sample_position] is None:
+                        key, value = samples[sample_position]
+                        lines[sample_position] = format_sample(m_name, value, key)
+                    continue
+                position = cached_position
+            lines[sample_position] = cached_lines[position]
+            position += 1
+
+        self.__render_cache[m_name] = (hashes, lines)
+        return ["".join(lines[start:start + size]) for start in range(0, len(lines), size)]
+
+    def checkpoint(self, collector_name, **labels):
         """Measure time for each category of calls to api and generate metrics"""
         now = time.time()
-        self.add("scrape_duration_seconds", value=(now - self.__last_collector_start_time), collector=collector_name)
+        self.add("scrape_duration_seconds", value=(now - self.__last_collector_start_time), collector=collector_name, **labels)
         self.__last_collector_start_time = now
+        if self.__profiler is not None:
+            self.__profiler.span(collector_name)
+
+class Snapshot():
+    """ Complete exposition of one scrape. The gzip version is compressed once, when it is first requested"""
+
+    __slots__ = ("body", "content_type", "timestamp", "__gzip_body", "__lock")
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.content_type = content_type
+        self.timestamp = time.time()
+        self.__gzip_body = None
+        self.__lock = threading.Lock()
+
+    def gzip_body(self):
+        """ return the gzip compressed body"""
+        with self.__lock:
+            if self.__gzip_body is None:
+                self.__gzip_body = gzip.compress(self.body, compresslevel=6)
+            return self.__gzip_body
+
+class Exposition():
+    """ Double buffered exposition used in long-running mode. It is used as the Metrics output :
+    the scrape is rendered in the back buffer and flush() publishes it as the new snapshot by swapping a reference.
+    Readers (HTTP handler, textfile writer) always get a complete scrape without locking, and the previous
+    generation is released as soon as no reader uses it anymore"""
+
+    def __init__(self, content_type=Metrics.content_types["prometheus"]):
+        self.__back = []
+        self.__snapshot = None
+        self.content_type = content_type
+
+    def write(self, data):
+        """ write rendered metrics to the back buffer"""
+        self.__back.append(data)
+        return len(data)
+
+    def flush(self):
+        """ publish the back buffer as the new snapshot"""
+        self.__snapshot = Snapshot("".join(self.__back).encode(), self.content_type)
+        self.__back = []
+
+    def get(self):
+        """ return the last published snapshot, None if no scrape has been completed yet"""
+        return self.__snapshot
+
+class MetricsHandler():
+    """ Serve the last published snapshot of an Exposition over HTTP. Mixed with http.server.BaseHTTPRequestHandler by
+    start_http_server"""
+    # pylint: disable=E1101
+
+    exposition = None
+
+    def do_GET(self):
+        """ return the last snapshot whatever the path is, gzip compressed if the client accepts it"""
+        snapshot = self.exposition.get()
+        if snapshot is None:
+            self.send_error(503, "first scrape not completed yet")
+            return
+
+        body = snapshot.body
+        self.send_response(200)
+        self.send_header("Content-Type", snapshot.content_type)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = snapshot.gzip_body()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+class RemoteWrite():
+    """ Push the samples of each scrape to a Prometheus remote write endpoint (snappy compressed protobuf WriteRequest).
+    Samples are timestamped with the start of the scrape and queued by batches in a bounded queue, the oldest batch is
+    dropped when the queue is full. A background thread sends the batches with retries and exponential backoff.
+    With changed_only, only new series and series whose value changed are pushed : unchanged series are pushed again every
+    resend_interval seconds so they don't become stale, and series that disappeared get a staleness marker"""
+
+    # Prometheus staleness marker : a NaN with a specific payload
+    __STALE_NAN = struct.pack("<Q", 0x7ff0000000000002)
+
+    # python-snappy module, imported by the first compress() call : False when it is not installed
+    __snappy = None
+
+    def __init__(self, url, batch_size=2000, queue_size=100, retries=5, timeout=30, min_backoff=0.5, max_backoff=30,
+                 changed_only=False, resend_interval=240, labels=None, headers=None):
+        self.url = url
+        self.batch_size = batch_size
+        self.retries = max(retries, 0)
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.changed_only = changed_only
+        self.resend_interval = resend_interval
+        self.labels = labels if labels is not None else {"job": "lotus-farcaster", "instance": socket.gethostname()}
+        self.headers = {
+            "Content-Encoding": "snappy",
+            "Content-Type": "application/x-protobuf",
+            "User-Agent": f"lotus-exporter-farcaster/{VERSION}",
+            "X-Prometheus-Remote-Write-Version": "0.1.0",
+            **(headers or {})
+        }
+        self.samples = {"sent": 0, "failed": 0, "dropped": 0}
+
+        # Sorted labels of each label set : {label names: [(encoded name, index of the value or None for external labels, name)]}
+        self.__layouts = {}
+        # Last value pushed of each series when changed_only is set : {(name, label names, label values): (value, time)}
+        self.__last = {}
+        self.__lock = threading.Lock()
+        self.__queue = queue.Queue(maxsize=queue_size)
+        self.__thread = threading.Thread(target=self.__send_loop, name="remote_write", daemon=True)
+        self.__thread.start()
+
+    def push(self, metrics):
+        """ encode the series of the scrape and queue them by batches"""
+        timestamp = int(metrics.start_time * 1000)
+        now = time.time()
+        last = {}
+        batch = []
+        for name, names, values, value in metrics.series():
+            value = self.to_float(value)
+            if value is None:
+                continue
+
+            if self.changed_only:
+                series_id = (name, names, values)
+                previous = self.__last.pop(series_id, None)
+                if previous is not None and previous[0] == value and now - previous[1] < self.resend_interval:
+                    last[series_id] = previous
+                    continue
+                last[series_id] = (value, now)
+
+            batch.append(self.encode_series(name, names, values, struct.pack("<d", value), timestamp))
+            if len(batch) >= self.batch_size:
+                self.__enqueue(batch)
+                batch = []
+
+        # Series of the previous push that are not in this scrape anymore are marked stale
+        for name, names, values in self.__last:
+            batch.append(self.encode_series(name, names, values, self.__STALE_NAN, timestamp))
+            if len(batch) >= self.batch_size:
+                self.__enqueue(batch)
+                batch = []
+        self.__last = last
+
+        if batch:
+            self.__enqueue(batch)
+
+    def close(self, timeout=None):
+        """ wait for the queued batches to be sent and stop the sender thread"""
+        self.__queue.put(None, timeout=timeout)
+        self.__thread.join(timeout)
+
+    def encode_series(self, name, names, values, value, timestamp):
+        """ return a protobuf encoded WriteRequest.timeseries field containing one sample. value is the encoded double"""
+        try:
+            layout = self.__layouts[names]
+        except KeyError:
+            layout = self.__layouts[names] = self.__layout(names)
+
+        field = self.field
+        labels = [field(1, b"\x0a\x08__name__" + field(2, name.encode()))]
+        for name_field, index, label_name in layout:
+            label = self.labels[label_name] if index is None else self.unescape(values[index])
+            labels.append(field(1, name_field + field(2, str(label).encode())))
+        labels.append(field(2, b"\x09" + value + b"\x10" + self.varint(timestamp)))
+        return field(1, b"".join(labels))
+
+    def __layout(self, names):
+        """ return the labels of a label set sorted by name, external labels don't override the labels of the series"""
+        labels = {label_name: None for label_name in self.labels}
+        labels.update({label_name: index for index, label_name in enumerate(names)})
+        return [(self.field(1, label_name.encode()), index, label_name) for label_name, index in sorted(labels.items())]
+
+    def __enqueue(self, batch):
+        """ queue a batch, the oldest queued batch is dropped if the queue is full"""
+        item = (len(batch), b"".join(batch))
+        while True:
+            try:
+                self.__queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    count, _ = self.__queue.get_nowait()
+                    self.__count("dropped", count)
+                    logging.warning(f"remote write queue full, {count} samples dropped")
+                except queue.Empty:
+                    pass
+
+    def __count(self, status, count):
+        with self.__lock:
+            self.samples[status] += count
+
+    def __send_loop(self):
+        """ send the queued batches until close() is called"""
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            count, data = item
+            self.__count("sent" if self.send(data) else "failed", count)
+
+    def send(self, data):
+        """ POST a WriteRequest. Connection errors, 5xx and 429 responses are retried with exponential backoff,
+        other responses are not retried. Return True if the request was accepted"""
+        import urllib.request
+        import urllib.error
+
+        request = urllib.request.Request(self.url, data=self.compress(data), headers=self.headers, method="POST")
+        backoff = self.min_backoff
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout):
+                    return True
+            except urllib.error.HTTPError as exp:
+                if exp.code < 500 and exp.code != 429:
+                    logging.error(f"remote write rejected by {self.url} : {exp.code} {exp.read()[:200]}")
+                    return False
+                error = exp
+            except (urllib.error.URLError, OSError) as exp:
+                error = exp
+            if attempt < self.retries:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+        logging.error(f"remote write to {self.url} failed after {self.retries + 1} attempts : {error}")
+        return False
+
+    @classmethod
+    def compress(cls, data):
+        """ snappy block compression. python-snappy is optional, without it data is stored as literals which any snappy
+        decoder accepts"""
+        if cls.__snappy is None:
+            try:
+                import snappy
+                cls.__snappy = snappy
+            except ImportError:
+                cls.__snappy = False
+        if cls.__snappy:
+            return cls.__snappy.compress(data)
+
+        output = [RemoteWrite.varint(len(data))]
+        for start in range(0, len(data), 65536):
+            chunk = data[start:start + 65536]
+            output.append(bytes([61 << 2]) + (len(chunk) - 1).to_bytes(2, "little") + chunk)
+        return b"".join(output)
+
+    @staticmethod
+    def field(number, data):
+        """ return a protobuf length-delimited field"""
+        return bytes([number << 3 | 2]) + RemoteWrite.varint(len(data)) + data
+
+    @staticmethod
+    def varint(number):
+        """ return a protobuf varint"""
+        output = bytearray()
+        while number > 0x7f:
+            output.append(number & 0x7f | 0x80)
+            number >>= 7
+        output.append(number)
+        return bytes(output)
+
+    @staticmethod
+    def to_float(value):
+        """ return the sample value as float, None if it is not a number"""
+        try:
+            return float(value)
+        except ValueError:
+            return {"True": 1.0, "False": 0.0}.get(value)
+
+    @staticmethod
+    def unescape(label):
+        """ revert Metrics.escape"""
+        label = str(label)
+        if "\\" in label:
+            label = re.sub(r"\\(.)", lambda match: "\n" if match.group(1) == "n" else match.group(1), label)
+        return label
+
+class Profiler():
+    """ Profile one scrape. The scrape is split in spans, one per collector (ended by Metrics.checkpoint), with their
+    duration, number of API calls, response bytes and peak memory. Two modes :
+      cprofile : deterministic profile of every function call and peak allocations of each span (tracemalloc). Slow
+      sampling : the stack of the scrape thread is sampled every interval seconds, peak memory is the process max RSS.
+                 The overhead is low enough to profile production miners
+    The event loop thread running the API calls is profiled too, and the miner threads of a multi-miner scrape when sampling"""
+
+    modes = ["sampling", "cprofile"]
+
+    def __init__(self, mode="sampling", interval=0.005):
+        self.mode = mode
+        self.interval = interval
+        self.spans = []
+        self.__start = self.__last = None
+        self.__rpc = (0, 0)
+        self.__stacks = collections.Counter()
+        self.__profile = None
+        self.__loop_profile = None
+        self.__sampler = None
+        self.__stop = threading.Event()
+
+    def start(self):
+        """ start profiling the calling thread"""
+        self.__start = self.__last = time.perf_counter()
+        self.__rpc = (RpcStats.total_calls, RpcStats.total_bytes)
+        if self.mode == "cprofile":
+            import cProfile
+            import tracemalloc
+
+            tracemalloc.start()
+            self.__profile = cProfile.Profile()
+            self.__loop_profile = cProfile.Profile()
+            Lotus.run_async(self.__enable(self.__loop_profile))
+            self.__profile.enable()
+        else:
+            self.__sampler = threading.Thread(target=self.__sample, args=(threading.get_ident(),), name="profiler", daemon=True)
+            self.__sampler.start()
+
+    def stop(self):
+        """ stop profiling"""
+        if self.__profile is not None:
+            self.__profile.disable()
+            Lotus.run_async(self.__disable(self.__loop_profile))
+            import tracemalloc
+            tracemalloc.stop()
+        if self.__sampler is not None:
+            self.__stop.set()
+            self.__sampler.join()
+
+    def span(self, name):
+        """ end the current span and start the next one"""
+        now = time.perf_counter()
+        if self.mode == "cprofile":
+            import tracemalloc
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+        else:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        self.spans.append({
+            "name": name,
+            "start": self.__last - self.__start,
+            "end": now - self.__start,
+            "rpc_calls": RpcStats.total_calls - self.__rpc[0],
+            "rpc_bytes": RpcStats.total_bytes - self.__rpc[1],
+            "peak_memory": peak
+        })
+        self.__last = now
+        self.__rpc = (RpcStats.total_calls, RpcStats.total_bytes)
+
+    @staticmethod
+    async def __enable(loop_profile):
+        """ enable a profile in the event loop thread"""
+        loop_profile.enable()
+
+    @staticmethod
+    async def __disable(loop_profile):
+        """ disable a profile in the event loop thread"""
+        loop_profile.disable()
+
+    def __sample(self, thread_id):
+        """ sample the stacks of the scrape thread, the event loop thread and the miner threads until stop() is called"""
+        while not self.__stop.wait(self.interval):
+            thread_ids = {thread_id, Lotus.loop_thread_id()} | {thread.ident for thread in threading.enumerate() if thread.name.startswith("miner")}
+            for ident, frame in sys._current_frames().items():
+                if ident not in thread_ids:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack:
+                    self.__stacks[tuple(reversed(stack))] += 1
+
+    def write(self, prefix, top=40):
+        """ write the report PREFIX.txt, the chrome trace PREFIX.trace.json (chrome://tracing, perfetto) and
+        PREFIX.prof (pstats) in cprofile mode or PREFIX.folded (flamegraph collapsed stacks) in sampling mode"""
+        report = [f"{'span':<20} {'start':>9} {'duration':>9} {'rpc':>7} {'rpc bytes':>12} {'peak memory':>12}"]
+        for span in self.spans:
+            report.append(f"{span['name']:<20} {span['start']:>8.3f}s {span['end'] - span['start']:>8.3f}s {span['rpc_calls']:>7} {span['rpc_bytes']:>12} {span['peak_memory']:>12}")
+        report.append("")
+
+        if self.__profile is not None:
+            import pstats
+            stream = io.StringIO()
+            stats = pstats.Stats(self.__profile, stream=stream)
+            stats.add(self.__loop_profile)
+            stats.dump_stats(f"{prefix}.prof")
+            stats.sort_stats("cumulative").print_stats(top)
+            report.append(stream.getvalue())
+        else:
+            with open(f"{prefix}.folded", "w", encoding="utf-8") as f:
+                for stack, count in self.__stacks.items():
+                    f.write(f"{';'.join(stack)} {count}\n")
+            total = sum(self.__stacks.values()) or 1
+            own = collections.Counter()
+            inclusive = collections.Counter()
+            for stack, count in self.__stacks.items():
+                own[stack[-1]] += count
+                for function in set(stack):
+                    inclusive[function] += count
+            report.append(f"{total} samples every {self.interval}s")
+            for title, counter in ("self", own), ("inclusive", inclusive):
+                report.append(f"\ntop {top} functions ({title})")
+                for function, count in counter.most_common(top):
+                    report.append(f"{100 * count / total:6.1f}% {count:>7}  {function}")
+
+        with open(f"{prefix}.txt", "w", encoding="utf-8") as f:
+            f.write("\n".join(report) + "\n")
+
+        events = [{"name": span["name"], "ph": "X", "pid": 1, "tid": 1, "ts": span["start"] * 1e6, "dur": (span["end"] - span["start"]) * 1e6,
+                   "args": {key: span[key] for key in ("rpc_calls", "rpc_bytes", "peak_memory")}} for span in self.spans]
+        with open(f"{prefix}.trace.json", "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+class MetricsFragment():
+    """ Samples of one refresh of a collector. They are added to the Metrics of every scrape until the next refresh of
+    the collector. Label values are stored as tuples, label names tuples are shared by the samples"""
+
+    def __init__(self, fmt="prometheus"):
+        self.fmt = fmt
+        self.samples = []
+        self.rendered = []
+        self.__label_names = {}
+
+    def add(self, metric: str = "", value: float = 1, **labels):
+        """ record a sample, same interface as Metrics.add"""
+        names = tuple(labels)
+        self.samples.append((metric, value, self.__label_names.setdefault(names, names), tuple(labels.values())))
+
+    def add_rendered(self, metric, samples, lines):
+        """ record samples rendered by a worker process, same interface as Metrics.add_rendered"""
+        self.rendered.append((metric, samples, lines))
+
+    def add_to(self, metrics):
+        """ add all the samples to metrics, then the rendered samples"""
+        add = metrics.add
+        for metric, value, names, values in self.samples:
+            add(metric, value, **dict(zip(names, values)))
+        for metric, samples, lines in self.rendered:
+            metrics.add_rendered(metric, samples, lines)
+
+class RenderedFragment():
+    """ Samples of a worker process keyed and rendered like Metrics does : {family: (samples, lines)} with samples the
+    list of (key, value) and lines their exposition lines. They are added to the scrape with Metrics.add_rendered"""
+
+    def __init__(self, fmt="prometheus"):
+        self.families = {}
+        self.__metrics = Metrics(output=None, fmt=fmt)
+
+    def add(self, metric: str = "", value: float = 1, **labels):
+        """ render a sample, same interface as Metrics.add"""
+        try:
+            samples, lines = self.families[metric]
+        except KeyError:
+            samples, lines = self.families[metric] = ([], [])
+        key = self.__metrics.series_key(labels)
+        value = str(value)
+        samples.append((key, value))
+        lines.append(self.__metrics.format_sample(metric, value, key))
+
+class MinerMetrics(MetricsFragment):
+    """ Samples of one miner of a multi-miner scrape. Each miner is collected in its own thread, its samples, collector
+    durations and errors are added to the Metrics of the scrape once all the miners are done"""
+
+    def __init__(self, fmt="prometheus"):
+        super().__init__(fmt)
+        self.errors = []
+        self.__last_collector_start_time = time.time()
+
+    def checkpoint(self, collector_name, **labels):
+        """ same as Metrics.checkpoint"""
+        now = time.time()
+        self.add("scrape_duration_seconds", value=(now - self.__last_collector_start_time), collector=collector_name, **labels)
+        self.__last_collector_start_time = now
+
+    def add_error(self, exp):
+        """ same as Metrics.add_error"""
+        self.errors.append(exp)
+
+    def add_to(self, metrics):
+        """ add the samples and the errors to metrics"""
+        super().add_to(metrics)
+        for exp in self.errors:
+            metrics.add_error(exp)
+
+class Collector():
+    """ A group of metrics refreshed every interval seconds (0 : every scrape). Between two refreshes, the samples of the
+    last refresh are added to the scrape instead of calling the APIs again. When a refresh fails, the samples of the last
+    successful refresh are kept (stale-while-revalidate) and the collector is refreshed again at the next scrape"""
+
+    __slots__ = ("name", "function", "interval", "network", "enabled", "last_refresh", "fragment", "success")
+
+    def __init__(self, name, function, interval=0, network=False):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.network = network
+        self.enabled = True
+        self.last_refresh = None
+        self.fragment = None
+        self.success = None
+
+    def is_due(self, now):
+        """ return True if the collector must be refreshed"""
+        return self.fragment is None or not self.success or now - self.last_refresh >= self.interval
+
+    def collect(self, context, metrics, keep=True):
+        """ refresh the collector if it is due and add its samples to metrics. Without keep, the samples are added
+        directly to metrics and nothing is kept"""
+        if not keep:
+            self.function(context, metrics)
+            self.success = True
+            self.last_refresh = time.time()
+            return
+
+        now = time.time()
+        if self.is_due(now):
+            fragment = MetricsFragment(metrics.fmt)
+            try:
+                self.function(context, fragment)
+            except Exception:
+                self.success = False
+                raise
+            self.fragment = fragment
+            self.success = True
+            self.last_refresh = now
+        self.fragment.add_to(metrics)
+
+    def add_stale(self, metrics):
+        """ mark the collector as failed and add the samples of its last successful refresh, if any"""
+        self.success = False
+        if self.fragment is not None:
+            self.fragment.add_to(metrics)
+
+class Collectors():
+    """ Scheduler of the collectors. In long-running mode the same instance is used by all the scrapes (keep=True) :
+    only the collectors that are due are refreshed, and a failing collector exports the samples of its last successful
+    refresh instead of failing the whole scrape. Intervals and the selection of the collectors can be set in config.toml
+    [collectors] or on the command line. When several miners share a daemon, only the collectors of one miner add the
+    network samples (network=True), the first one until it fails"""
+
+    def __init__(self, keep=False, network=True):
+        self.keep = keep
+        self.network = network
+        self.collectors = [Collector(name, function, interval, network) for name, (function, interval, network) in COLLECTORS.items()]
+        self.labels = {}
+
+    @staticmethod
+    def resolve(names):
+        """ return the collector names of the list (case insensitive), raise an exception on unknown names"""
+        known = {name.lower(): name for name in COLLECTORS}
+        resolved = []
+        for name in names:
+            if name.lower() not in known:
+                raise Exception(f'collectors : unknown collector "{name}", valid collectors are {", ".join(COLLECTORS)}')
+            resolved.append(known[name.lower()])
+        return resolved
+
+    def configure(self, settings=None, include=None, exclude=None):
+        """ set the refresh interval and the selection of the collectors. settings is the [collectors] section of
+        config.toml : intervals = {name: seconds} overriding the defaults, enabled = [names] to run only these collectors,
+        excluded = [names] to skip collectors. include and exclude (command line) override enabled and excluded"""
+        settings = settings or {}
+        intervals = dict(zip(self.resolve(settings.get("intervals", {})), settings.get("intervals", {}).values()))
+        include = include if include is not None else settings.get("enabled")
+        include = None if include is None else self.resolve(include)
+        exclude = self.resolve(exclude if exclude is not None else settings.get("excluded", []))
+
+        for collector in self.collectors:
+            collector.interval = float(intervals.get(collector.name, COLLECTORS[collector.name][1]))
+            collector.enabled = (include is None or collector.name in include) and collector.name not in exclude
+            if not collector.enabled:
+                collector.fragment = None
+                collector.last_refresh = collector.success = None
+
+    def set_network(self, network):
+        """ give or take the network role. All the collectors are refreshed at the next scrape, so the network samples
+        are neither missing nor exported twice"""
+        self.network = network
+        for collector in self.collectors:
+            collector.fragment = None
+            collector.last_refresh = collector.success = None
+
+    def collect(self, context, metrics):
+        """ run the enabled collectors in order, the duration of each one is measured by Metrics.checkpoint. The network
+        collectors only run in the context adding the network samples"""
+        self.labels = context.labels
+        for collector in self.collectors:
+            if not collector.enabled or (collector.network and not context.network):
+                continue
+            try:
+                collector.collect(context, metrics, self.keep)
+            except Exception as exp:
+                if not self.keep:
+                    raise
+                logging.error(f"collector {collector.name} failed, exporting its last samples : {exp}")
+                metrics.add_error(exp)
+                collector.add_stale(metrics)
+            metrics.checkpoint(collector.name, **self.labels)
+        if self.keep:
+            self.add_status(metrics)
+
+    def fail(self, metrics, exp):
+        """ the scrape failed before the collectors could run (node unreachable...) : export the last samples of all the collectors"""
+        logging.error(f"scrape failed, exporting the last samples of the collectors : {exp}")
+        metrics.add_error(exp)
+        for collector in self.collectors:
+            if collector.enabled and (self.network or not collector.network):
+                collector.add_stale(metrics)
+        self.add_status(metrics)
+
+    def add_status(self, metrics):
+        """ add the age of the samples and the status of the last refresh of each collector. Only in long-running mode,
+        a one-shot scrape refreshes all the collectors and fails as a whole"""
+        now = time.time()
+        for collector in self.collectors:
+            if collector.last_refresh is not None:
+                metrics.add("scrape_collector_age_seconds", value=round(now - collector.last_refresh, 3), collector=collector.name, **self.labels)
+            if collector.success is not None:
+                metrics.add("scrape_collector_success", value=int(collector.success), collector=collector.name, **self.labels)
+
+class CollectorContext():
+    """ Nodes and configuration of the scrape shared by the collectors. API results used by several collectors are
+    retrieved once per scrape with get(). labels are added to the samples describing the collectors (duration, status).
+    network tells the collectors to add the samples of the daemon and the chain, which are the same for all the miners of
+    the daemon. They are labelled with network_labels : the miner id for a single miner, no label when the collectors
+    samples are labelled by miner"""
+
+    def __init__(self, daemon, miner, markets, addresses_config, config, labels=None, network=True):
+        self.daemon = daemon
+        self.miner = miner
+        self.markets = markets
+        self.addresses_config = addresses_config
+        self.config = config
+        self.miner_id = miner.id()
+        self.labels = {key: self.miner_id if value is None else value for key, value in (labels or {}).items()}
+        self.network = network
+        self.network_labels = {} if "miner_id" in self.labels else {"miner_id": self.miner_id}
+        self.__results = {}
+
+    def get(self, node, method, params):
+        """ node.get(method, params), the result is kept for the rest of the scrape"""
+        key = (node.target, method, json.dumps(params))
+        if key not in self.__results:
+            self.__results[key] = node.get(method, params)
+        return self.__results[key]
 
 #################################################################################
 # FUNCTIONS
@@ -1067,25 +2605,53 @@ def load_toml(toml_file):
     else:
         return nested_dict
 
-def collect(daemon, miner, markets, metrics, addresses_config):
-    """ run metrics collection and export """
+# Collectors in execution order : {name: (function, default refresh interval in seconds, network)}, filled by register_collector
+COLLECTORS = {}
 
-    # miner_id
-    miner_id = miner.id()
+def register_collector(name, interval=0, network=False):
+    """ register function(context, metrics) as the collector name, refreshed every interval seconds by default (0 : every scrape).
+    A network collector only adds samples of the daemon and the chain, it runs once for all the miners of the daemon"""
+    def register(function):
+        COLLECTORS[name] = (function, interval, network)
+        return function
+    return register
+
+def collect(daemon, miner, markets, metrics, addresses_config, config=None, collectors=None, labels=None):
+    """ run metrics collection and export. Without a scheduler kept between scrapes, all the collectors are refreshed.
+    labels are added to the collector durations and status, a None value is replaced by the miner id"""
+
+    config = config or {}
 
     # Add KNOWN_ADDRESSES to Lotus OBJ
     if "known_addresses" in addresses_config.keys():
         daemon.add_known_addresses(addresses_config["known_addresses"])
 
-    metrics.add("chain_basefee", value=daemon.basefee(), miner_id=miner_id)
+    if collectors is None:
+        collectors = Collectors()
+        collectors.configure(config.get("collectors"))
+    collectors.collect(CollectorContext(daemon, miner, markets, addresses_config, config, labels, collectors.network), metrics)
+
+
+@register_collector("ChainHead", network=True)
+def collect_chain_head(context, metrics):
+    """ basefee and height of the chain head """
+    daemon = context.daemon
+    labels = context.network_labels
+
+    metrics.add("chain_basefee", value=daemon.basefee(), **labels)
 
     # CHAIN HEIGHT
-    metrics.add("chain_height", value=daemon.chain_head()["Height"], miner_id=miner_id)
-    metrics.checkpoint("ChainHead")
+    metrics.add("chain_height", value=daemon.chain_head()["Height"], **labels)
+
+@register_collector("ChainSync", network=True)
+def collect_chain_sync(context, metrics):
+    """ sync status of the daemon workers """
+    daemon = context.daemon
+    labels = context.network_labels
 
     # GENERATE CHAIN SYNC STATUS
     sync_status = daemon.get("SyncState", [])
-    current_epoch = int((time.time() - 1598306400) / 30)
+    current_epoch = int((time.time() - GENESIS_TIMESTAMP) / EPOCH_DURATION)
     for worker in sync_status["result"]["ActiveSyncs"]:
         try:
             if worker["Height"] > 0:
@@ -1094,16 +2660,21 @@ def collect(daemon, miner, markets, metrics, addresses_config):
                 diff_height = -1
         except Exception:
             diff_height = -1
-        metrics.add("chain_sync_diff", value=diff_height, miner_id=miner_id, worker_id=sync_status["result"]["ActiveSyncs"].index(worker))
-        metrics.add("chain_sync_status", value=worker["Stage"], miner_id=miner_id, worker_id=sync_status["result"]["ActiveSyncs"].index(worker))
-    metrics.checkpoint("ChainSync")
+        metrics.add("chain_sync_diff", value=diff_height, **labels, worker_id=sync_status["result"]["ActiveSyncs"].index(worker))
+        metrics.add("chain_sync_status", value=worker["Stage"], **labels, worker_id=sync_status["result"]["ActiveSyncs"].index(worker))
+
+@register_collector("StateMinerInfo", interval=600)
+def collect_miner_info(context, metrics):
+    """ miner version, addresses and sector size """
+    daemon = context.daemon
+    miner = context.miner
+    miner_id = context.miner_id
 
     # GENERATE MINER INFO
     miner_version = miner.get("Version", [])
-    metrics.checkpoint("Miner")
 
     # RETRIEVE MAIN ADDRESSES
-    daemon_stats = daemon.get("StateMinerInfo", [miner_id, daemon.tipset_key()])
+    daemon_stats = daemon.get_tipset("StateMinerInfo", [miner_id, daemon.tipset_key()])
     miner_owner = daemon_stats["result"]["Owner"]
     miner_owner_addr = daemon.get("StateAccountKey", [miner_owner, daemon.tipset_key()])["result"]
     miner_worker = daemon_stats["result"]["Worker"]
@@ -1124,18 +2695,30 @@ def collect(daemon, miner, markets, metrics, addresses_config):
 
     metrics.add("miner_info", value=1, miner_id=miner_id, version=miner_version["result"]["Version"], owner=miner_owner, owner_addr=miner_owner_addr, worker=miner_worker, worker_addr=miner_worker_addr, control0=miner_control0, control0_addr=miner_control0_addr)
     metrics.add("miner_info_sector_size", value=daemon_stats["result"]["SectorSize"], miner_id=miner_id)
-    metrics.checkpoint("StateMinerInfo")
+
+@register_collector("Daemon", interval=600, network=True)
+def collect_daemon(context, metrics):
+    """ daemon version, network and reachability """
+    daemon = context.daemon
+    labels = context.network_labels
 
     # GENERATE DAEMON INFO
     daemon_network = daemon.get("StateNetworkName", [])
-    daemon_network_version = daemon.get("StateNetworkVersion", [daemon.tipset_key()])
+    daemon_network_version = daemon.get_tipset("StateNetworkVersion", [daemon.tipset_key()])
+    daemon.check_network_version(daemon_network_version["result"])
     daemon_version = daemon.get("Version", [])
-    metrics.add("info", value=daemon_network_version["result"], miner_id=miner_id, version=daemon_version["result"]["Version"], network=daemon_network["result"])
+    metrics.add("info", value=daemon_network_version["result"], **labels, version=daemon_version["result"]["Version"], network=daemon_network["result"])
 
     # GENERATE DAEMON INFO
     daemon_net = daemon.get("NetAutoNatStatus",[])
-    metrics.add("net_public_reachability", value=daemon_net["result"]["Reachability"], miner_id=miner_id)
-    metrics.checkpoint("Daemon")
+    metrics.add("net_public_reachability", value=daemon_net["result"]["Reachability"], **labels)
+
+@register_collector("Balances", interval=300)
+def collect_balances(context, metrics):
+    """ wallets balance, verified datacap and miner locked funds """
+    daemon = context.daemon
+    miner_id = context.miner_id
+    addresses_config = context.addresses_config
 
     # GENERATE WALLET
     if "external_wallets" in addresses_config:
@@ -1152,17 +2735,23 @@ def collect(daemon, miner, markets, metrics, addresses_config):
     locked_funds = daemon.get("StateReadState", [miner_id, daemon.tipset_key()])
     for i in ["PreCommitDeposits", "LockedFunds", "FeeDebt", "InitialPledge"]:
         metrics.add("wallet_locked_balance", value=int(locked_funds["result"]["State"][i])/1000000000000000000, miner_id=miner_id, address=miner_id, locked_type=i)
-    metrics.checkpoint("Balances")
+
+@register_collector("Power")
+def collect_power(context, metrics):
+    """ miner and network power, mining eligibility """
+    daemon = context.daemon
+    miner_id = context.miner_id
 
     # GENERATE POWER
-    powerlist = daemon.get("StateMinerPower", [miner_id, daemon.tipset_key()])
+    powerlist = daemon.get_tipset("StateMinerPower", [miner_id, daemon.tipset_key()])
     for minerpower in powerlist["result"]["MinerPower"]:
         metrics.add("power", value=powerlist["result"]["MinerPower"][minerpower], miner_id=miner_id, scope="miner", power_type=minerpower)
-    for totalpower in powerlist["result"]["TotalPower"]:
-        metrics.add("power", value=powerlist["result"]["TotalPower"][totalpower], miner_id=miner_id, scope="network", power_type=totalpower)
+    if context.network:
+        for totalpower in powerlist["result"]["TotalPower"]:
+            metrics.add("power", value=powerlist["result"]["TotalPower"][totalpower], **context.network_labels, scope="network", power_type=totalpower)
 
     # Mining eligibility
-    base_info = daemon.get("MinerGetBaseInfo", [miner_id, daemon.chain_head()["Height"], daemon.tipset_key()])
+    base_info = daemon.get_tipset("MinerGetBaseInfo", [miner_id, daemon.chain_head()["Height"], daemon.tipset_key()])
 
     if base_info["result"] is None:
         logging.error(f'MinerGetBaseInfo returned no result')
@@ -1176,50 +2765,76 @@ def collect(daemon, miner, markets, metrics, addresses_config):
     else:
         eligibility = 0
     metrics.add("power_mining_eligibility", value=eligibility, miner_id=miner_id)
-    metrics.checkpoint("Power")
+
+@register_collector("MPool")
+def collect_mpool(context, metrics):
+    """ message pool and local pending messages """
+    daemon = context.daemon
+    miner_id = context.miner_id
 
     # GENERATE MPOOL
-    mpool_total = len(daemon.get("MpoolPending", [daemon.tipset_key()])["result"])
     local_mpool = daemon.get_local_mpool_pending_enhanced(miner_id)
     local_mpool_total = len(local_mpool)
 
-    metrics.add("mpool_total", value=mpool_total, miner_id=miner_id)
+    if context.network:
+        mpool_total = len(daemon.get("MpoolPending", [daemon.tipset_key()])["result"])
+        metrics.add("mpool_total", value=mpool_total, **context.network_labels)
     metrics.add("mpool_local_total", value=local_mpool_total, miner_id=miner_id)
 
     for msg in local_mpool:
         metrics.add("mpool_local_message", value=1, miner_id=miner_id, msg_from=msg["display_from"], msg_to=msg["display_to"], msg_nonce=msg["Nonce"], msg_value=msg["Value"], msg_gaslimit=msg["GasLimit"], msg_gasfeecap=msg["GasFeeCap"], msg_gaspremium=msg["GasPremium"], msg_method=msg["Method"], msg_method_type=msg["method_type"], msg_to_actor_type=msg["actor_type"])
-    metrics.checkpoint("MPool")
+
+@register_collector("NetPeers", interval=60)
+def collect_net_peers(context, metrics):
+    """ number of peers of the daemon and the markets node """
+    daemon = context.daemon
+    markets = context.markets
+    miner_id = context.miner_id
 
     # GENERATE NET_PEERS
-    daemon_netpeers = daemon.get("NetPeers", [])
-    metrics.add("netpeers_total", value=len(daemon_netpeers["result"]), miner_id=miner_id)
+    if context.network:
+        daemon_netpeers = daemon.get("NetPeers", [])
+        metrics.add("netpeers_total", value=len(daemon_netpeers["result"]), **context.network_labels)
 
     markets_netpeers = markets.get("NetPeers", [])
     metrics.add("miner_netpeers_total", value=len(markets_netpeers["result"]), miner_id=miner_id)
-    metrics.checkpoint("NetPeers")
+
+@register_collector("NetBandwidth")
+def collect_net_bandwidth(context, metrics):
+    """ bandwidth counters of the daemon and the markets node """
+    daemon = context.daemon
+    markets = context.markets
+    miner_id = context.miner_id
 
     # GENERATE NETSTATS XXX Verfier la qualité des stats ... lotus net, API et Grafana sont tous differents
-    protocols_list = daemon.get("NetBandwidthStatsByProtocol", [])
-    for protocol in protocols_list["result"]:
-        metrics.add("net_protocol_in", value=protocols_list["result"][protocol]["TotalIn"], miner_id=miner_id, protocol=protocol)
-        metrics.add("net_protocol_out", value=protocols_list["result"][protocol]["TotalOut"], miner_id=miner_id, protocol=protocol)
+    if context.network:
+        protocols_list = daemon.get("NetBandwidthStatsByProtocol", [])
+        for protocol in protocols_list["result"]:
+            metrics.add("net_protocol_in", value=protocols_list["result"][protocol]["TotalIn"], **context.network_labels, protocol=protocol)
+            metrics.add("net_protocol_out", value=protocols_list["result"][protocol]["TotalOut"], **context.network_labels, protocol=protocol)
 
     protocols_list = markets.get("NetBandwidthStatsByProtocol", [])
     for protocol in protocols_list["result"]:
         metrics.add("miner_net_protocol_in", value=protocols_list["result"][protocol]["TotalIn"], miner_id=miner_id, protocol=protocol)
         metrics.add("miner_net_protocol_out", value=protocols_list["result"][protocol]["TotalOut"], miner_id=miner_id, protocol=protocol)
 
-    net_list = daemon.get("NetBandwidthStats", [])
-    metrics.add("net_total_in", value=net_list["result"]["TotalIn"], miner_id=miner_id)
-    metrics.add("net_total_out", value=net_list["result"]["TotalOut"], miner_id=miner_id)
+    if context.network:
+        net_list = daemon.get("NetBandwidthStats", [])
+        metrics.add("net_total_in", value=net_list["result"]["TotalIn"], **context.network_labels)
+        metrics.add("net_total_out", value=net_list["result"]["TotalOut"], **context.network_labels)
 
     net_list = markets.get("NetBandwidthStats", [])
     metrics.add("miner_net_total_in", value=net_list["result"]["TotalIn"], miner_id=miner_id)
     metrics.add("miner_net_total_out", value=net_list["result"]["TotalOut"], miner_id=miner_id)
-    metrics.checkpoint("NetBandwidth")
+
+@register_collector("Workers", interval=60)
+def collect_workers(context, metrics):
+    """ hardware and resources used by the workers """
+    miner = context.miner
+    miner_id = context.miner_id
 
     # GENERATE WORKER INFOS
-    workerstats = miner.get("WorkerStats", [])
+    workerstats = context.get(miner, "WorkerStats", [])
     # XXX 1.2.1 introduce a new worker_id format. Later we should delete it, its a useless info.
     #print("# HELP lotus_miner_worker_id All lotus worker information prfer to use workername than workerid which is changing at each restart")
     #print("# TYPE lotus_miner_worker_id gauge")
@@ -1342,9 +2957,15 @@ def collect(daemon, miner, markets, metrics, addresses_config):
             metrics.add("miner_worker_vmem_tasks", value=vmem_tasks, miner_id=miner_id, worker_host=worker_host)
             metrics.add("miner_worker_gpu_used", value=gpu_used, miner_id=miner_id, worker_host=worker_host)
             metrics.add("miner_worker_cpu_used", value=cpu_used, miner_id=miner_id, worker_host=worker_host)
-    metrics.checkpoint("Workers")
+
+@register_collector("Jobs")
+def collect_jobs(context, metrics):
+    """ jobs running on the workers """
+    miner = context.miner
+    miner_id = context.miner_id
 
     # GENERATE JOB INFOS
+    workerstats = context.get(miner, "WorkerStats", [])
     workerjobs = miner.get("WorkerJobs", [])
     for (wrk, job_list) in workerjobs["result"].items():
         for job in job_list:
@@ -1361,7 +2982,12 @@ def collect(daemon, miner, markets, metrics, addresses_config):
             run_wait = str(job['RunWait'])
             job_start_epoch = time.mktime(time.strptime(job_start_time[:19], '%Y-%m-%dT%H:%M:%S'))
             metrics.add("miner_worker_job", value=(time.time() - job_start_epoch), miner_id=miner_id, job_id=job_id, worker_host=worker_host, task=task, sector_id=sector, job_start_time=job_start_time, run_wait=run_wait)
-    metrics.checkpoint("Jobs")
+
+@register_collector("SchedDiag")
+def collect_sched_diag(context, metrics):
+    """ jobs waiting in the scheduler """
+    miner = context.miner
+    miner_id = context.miner_id
 
     # GENERATE JOB SCHEDDIAG
     scheddiag = miner.get("SealingSchedDiag", [True])
@@ -1371,7 +2997,14 @@ def collect(daemon, miner, markets, metrics, addresses_config):
             sector = req["Sector"]["Number"]
             task = req["TaskType"]
             metrics.add("miner_worker_job", miner_id=miner_id, job_id="", worker="", task=task, sector_id=sector, start="", run_wait="99")
-    metrics.checkpoint("SchedDiag")
+
+@register_collector("Sectors", interval=300)
+def collect_sectors(context, metrics):
+    """ state, weight, power, events and deals of all the sectors """
+    daemon = context.daemon
+    miner = context.miner
+    miner_id = context.miner_id
+    config = context.config
 
     # GENERATE SECTORS
     sector_list = miner.get("SectorsList", [])
@@ -1379,89 +3012,81 @@ def collect(daemon, miner, markets, metrics, addresses_config):
     # remove duplicate sector ID (lotus bug)
     unique_sector_list = set(sector_list["result"])
 
-    size = int(daemon_stats["result"]["SectorSize"])
-
-    # Sector list will be retrieved in ASYNC mode for performance reason (x5 faster)
-    # We build the list of requests we want to batch together
-    # We want to retrieve all sectors details + OnChain information
-    request_list = []
-    for sector in unique_sector_list:
-        request_list.append(["SectorsStatus", [sector, True]])
-    # We execute the batch
-    details = miner.get_multiple(request_list)
-
-    # We go though all sectors and enhanced them
-    for i, sector in enumerate(unique_sector_list):
-        detail = details[i]
-        deals = len(detail["result"]["Deals"])-detail["result"]["Deals"].count(0)
-        verified_weight = 0
-        deal_weight = 0
-        qa_power = size
-
-        if deals > 0 and detail["result"]["State"] != "Removed":
-            duration = int(detail["result"]["Expiration"]) - int(detail["result"]["Activation"])
-            verified_weight = int(detail["result"]["VerifiedDealWeight"])
-            deal_weight = int(detail["result"]["DealWeight"])
-            qa_power = daemon.qa_power_for_weight(size, duration, deal_weight, verified_weight)
-
-        try:
-            creation_date = detail["result"]["Log"][0]["Timestamp"]
-        except Exception as exp:
-            logging.warning(f"Sector {i} : cannot find sector creation date : {exp}")
-            creation_date = 0
-            pass
-        packed_date = ""
-        finalized_date = ""
+    size = int(daemon.get_tipset("StateMinerInfo", [miner_id, daemon.tipset_key()])["result"]["SectorSize"])
 
-        if detail["result"]["Log"]:
-            creation_date = detail["result"]["Log"][0]["Timestamp"]
+    # All sectors information is stored in a compact sector table
+    sector_table = SectorTable()
 
-        for log in range(len(detail["result"]["Log"])):
-            if detail["result"]["Log"][log]["Kind"] == "event;sealing.SectorPacked":
-                packed_date = detail["result"]["Log"][log]["Timestamp"]
-            if detail["result"]["Log"][log]["Kind"] == "event;sealing.SectorFinalized":
-                finalized_date = detail["result"]["Log"][log]["Timestamp"]
+    # In bulk mode, on-chain information of all the sectors is retrieved from the daemon in one StateMinerSectors call
+    # and joined by sector number with the sector states of the miner. Only the sectors that are not in a long-term state
+    # (sealing, removed, ...) are still retrieved one by one with SectorsStatus.
+    if config.get("sectors_bulk_onchain", False):
+        onchain_sectors = daemon.get_miner_sectors_enhanced(miner_id)
+        for sector, state in miner.get_sectors_in_states(miner.onchain_states).items():
+            if sector in unique_sector_list and sector in onchain_sectors:
+                sector_table.add_onchain(sector, state, onchain_sectors[sector], size)
+        del onchain_sectors
 
-        try:
-            if detail["result"]["Log"][0]["Kind"] == "event;sealing.SectorStartCC":
-                pledged = 1
-            else:
-                pledged = 0
-        except Exception as exp:
-            logging.warning(f"Sector {i} : cannot find sector kind, default to CC : {exp}")
-            pledged = 1
-            pass
-        metrics.add("miner_sector_state", value=1, miner_id=miner_id, sector_id=sector, state=detail["result"]["State"], to_upgrade=detail["result"]["ToUpgrade"], pledged=pledged, deals=deals)
-        metrics.add("miner_sector_weight", value=verified_weight, weight_type="verified", miner_id=miner_id, sector_id=sector)
-        metrics.add("miner_sector_weight", value=deal_weight, weight_type="non_verified", miner_id=miner_id, sector_id=sector)
-        metrics.add("miner_sector_qa_power", value=qa_power, miner_id=miner_id, sector_id=sector)
-
-        if packed_date != "":
-            metrics.add("miner_sector_event", value=packed_date, miner_id=miner_id, sector_id=sector, event_type="packed")
-        if creation_date != "":
-            metrics.add("miner_sector_event", value=creation_date, miner_id=miner_id, sector_id=sector, event_type="creation")
-        if finalized_date != "":
-            metrics.add("miner_sector_event", value=finalized_date, miner_id=miner_id, sector_id=sector, event_type="finalized")
-
-        if detail["result"]["State"] not in ["Proving", "Removed"]:
-            for deal in detail["result"]["Deals"]:
-                if deal != 0:
-                    deal_info = daemon.get_deal_info_enhanced(deal)
-                    deal_is_verified = deal_info["VerifiedDeal"]
-                    deal_size = deal_info["PieceSize"]
-                    deal_price_per_epoch = deal_info["StoragePricePerEpoch"]
-                    deal_provider_collateral = deal_info["ProviderCollateral"]
-                    deal_client_collateral = deal_info["ClientCollateral"]
-                    deal_start_epoch = deal_info["StartEpoch"]
-                    deal_end_epoch = deal_info["EndEpoch"]
-                    deal_client = deal_info["Client"]
-
-                    metrics.add("miner_sector_sealing_deals_info", value=1, miner_id=miner_id, sector_id=sector, deal_id=deal, deal_is_verified=deal_is_verified, deal_price_per_epoch=deal_price_per_epoch, deal_provider_collateral=deal_provider_collateral, deal_client_collateral=deal_client_collateral, deal_size=deal_size, deal_start_epoch=deal_start_epoch, deal_end_epoch=deal_end_epoch, deal_client=deal_client)
-
-    metrics.checkpoint("Sectors")
+    # Sector list will be retrieved in ASYNC mode for performance reason (x5 faster)
+    # We want to retrieve all sectors details + OnChain information
+    sector_ids = [sector for sector in unique_sector_list if sector not in sector_table]
+    pool = SectorTable.process_pool(int(config.get("sectors_processes", 0)))
+    if pool is None:
+        sector_table.load_status(miner, sector_ids, size)
+
+    # We go though all sectors and generate the metrics
+    for sector in sector_table:
+        add_sector_samples(metrics, sector, miner_id)
+        add_sector_deals(metrics, daemon, miner_id, sector.sector_id, sector.deal_ids)
+
+    # With sectors_processes, the SectorsStatus responses are decoded and the samples rendered by the worker processes
+    if pool is not None:
+        for families, deals in sector_table.process_status(miner, sector_ids, size, miner_id, pool, metrics.fmt):
+            for metric, (samples, lines) in families.items():
+                metrics.add_rendered(metric, samples, lines)
+            for sector_id, deal_ids in deals:
+                add_sector_deals(metrics, daemon, miner_id, sector_id, deal_ids)
+
+def add_sector_samples(metrics, sector, miner_id):
+    """ add the state, weight, power and events samples of a sector"""
+    sector_id = sector.sector_id
+    metrics.add("miner_sector_state", value=1, miner_id=miner_id, sector_id=sector_id, state=sector.state, to_upgrade=sector.to_upgrade, pledged=sector.pledged, deals=sector.deals)
+    metrics.add("miner_sector_weight", value=sector.verified_weight, weight_type="verified", miner_id=miner_id, sector_id=sector_id)
+    metrics.add("miner_sector_weight", value=sector.deal_weight, weight_type="non_verified", miner_id=miner_id, sector_id=sector_id)
+    metrics.add("miner_sector_qa_power", value=sector.qa_power, miner_id=miner_id, sector_id=sector_id)
+
+    if sector.packed_date != "":
+        metrics.add("miner_sector_event", value=sector.packed_date, miner_id=miner_id, sector_id=sector_id, event_type="packed")
+    if sector.creation_date != "":
+        metrics.add("miner_sector_event", value=sector.creation_date, miner_id=miner_id, sector_id=sector_id, event_type="creation")
+    if sector.finalized_date != "":
+        metrics.add("miner_sector_event", value=sector.finalized_date, miner_id=miner_id, sector_id=sector_id, event_type="finalized")
+
+def add_sector_deals(metrics, daemon, miner_id, sector_id, deal_ids):
+    """ add the information of the deals of a sealing sector"""
+    for deal in deal_ids:
+        deal_info = daemon.get_deal_info_enhanced(deal)
+        deal_is_verified = deal_info["VerifiedDeal"]
+        deal_size = deal_info["PieceSize"]
+        deal_price_per_epoch = deal_info["StoragePricePerEpoch"]
+        deal_provider_collateral = deal_info["ProviderCollateral"]
+        deal_client_collateral = deal_info["ClientCollateral"]
+        deal_start_epoch = deal_info["StartEpoch"]
+        deal_end_epoch = deal_info["EndEpoch"]
+        deal_client = deal_info["Client"]
+
+        metrics.add("miner_sector_sealing_deals_info", value=1, miner_id=miner_id, sector_id=sector_id, deal_id=deal, deal_is_verified=deal_is_verified, deal_price_per_epoch=deal_price_per_epoch, deal_provider_collateral=deal_provider_collateral, deal_client_collateral=deal_client_collateral, deal_size=deal_size, deal_start_epoch=deal_start_epoch, deal_end_epoch=deal_end_epoch, deal_client=deal_client)
+
+@register_collector("Deadlines")
+def collect_deadlines(context, metrics):
+    """ deadlines, partitions and partition membership of the sectors """
+    daemon = context.daemon
+    miner_id = context.miner_id
 
     # GENERATE DEADLINES
-    deadlines = daemon.get_deadlines_enhanced(miner_id)
+    # Partitions membership of the sectors is stored in its own sector table, the deadlines are refreshed independently of the sectors
+    sector_table = SectorTable()
+    deadlines = daemon.get_deadlines_enhanced(miner_id, sector_table)
     metrics.add("miner_deadline_info", value=1, miner_id=miner_id, current_idx=deadlines["cur"]["Index"], current_epoch=deadlines["cur"]["CurrentEpoch"], current_open_epoch=deadlines["cur"]["Open"], wpost_period_deadlines=deadlines["cur"]["WPoStPeriodDeadlines"], wpost_challenge_window=deadlines["cur"]["WPoStChallengeWindow"])
     for dl_id, deadline in deadlines["deadlines"].items():
         metrics.add("miner_deadline_active_start", value=deadline["StartIn"], miner_id=miner_id, index=dl_id)
@@ -1472,15 +3097,21 @@ def collect(daemon, miner, markets, metrics, addresses_config):
         metrics.add("miner_deadline_active_sectors_faulty", value=deadline["FaultySectorsCount"], miner_id=miner_id, index=dl_id)
         metrics.add("miner_deadline_active_sectors_active", value=deadline["ActiveSectorsCount"], miner_id=miner_id, index=dl_id)
         metrics.add("miner_deadline_active_sectors_live", value=deadline["LiveSectorsCount"], miner_id=miner_id, index=dl_id)
-        for partition_id, partition in deadline["partitions"].items():
-            for sector_id in partition.keys():
-                is_active = "Active" in partition[sector_id]
-                is_live = "Live" in partition[sector_id]
-                is_recovering = "Recovering" in partition[sector_id]
-                is_faulty = "Faulty" in partition[sector_id]
-                metrics.add("miner_deadline_active_partition_sector", is_active=is_active, is_live=is_live, is_recovering=is_recovering, is_faulty=is_faulty, value=1, miner_id=miner_id, deadline_id=dl_id, partition_id=partition_id, sector_id=sector_id)
-    metrics.checkpoint("Deadlines")
 
+    flags = Sector.partition_flags
+    for sector in sector_table:
+        if sector.deadline_id is not None:
+            is_active = sector.is_in_partition(flags["Active"])
+            is_live = sector.is_in_partition(flags["Live"])
+            is_recovering = sector.is_in_partition(flags["Recovering"])
+            is_faulty = sector.is_in_partition(flags["Faulty"])
+            metrics.add("miner_deadline_active_partition_sector", is_active=is_active, is_live=is_live, is_recovering=is_recovering, is_faulty=is_faulty, value=1, miner_id=miner_id, deadline_id=sector.deadline_id, partition_id=sector.partition_id, sector_id=sector.sector_id)
+
+@register_collector("Storage", interval=300)
+def collect_storage(context, metrics):
+    """ storage paths and capacity """
+    miner = context.miner
+    miner_id = context.miner_id
 
     # GENERATE STORAGE INFO
     for sto in miner.get_storagelist_enhanced():
@@ -1488,7 +3119,13 @@ def collect(daemon, miner, markets, metrics, addresses_config):
         metrics.add("miner_storage_capacity", value=sto["capacity"], miner_id=miner_id, storage_id=sto["storage_id"])
         metrics.add("miner_storage_available", value=sto["available"], miner_id=miner_id, storage_id=sto["storage_id"])
         metrics.add("miner_storage_reserved", value=sto["reserved"], miner_id=miner_id, storage_id=sto["storage_id"])
-    metrics.checkpoint("Storage")
+
+@register_collector("Market")
+def collect_market(context, metrics):
+    """ deals waiting to be published """
+    daemon = context.daemon
+    markets = context.markets
+    miner_id = context.miner_id
 
     # GENERATE MARKET INFO
     #market_info = markets.get_market_info_enhanced()
@@ -1573,7 +3210,6 @@ def collect(daemon, miner, markets, metrics, addresses_config):
 #
 #
 
-    metrics.checkpoint("Market")
     # XXX RAJOUTER : PublishPeriodStart / PublishINseconds / Expected collateral Against ProviderCollateral
 
     # GENERATE DEALS INFOS
@@ -1625,7 +3261,55 @@ def get_url_and_token(string):
 
     return (url, token)
 
-def run(args, output):
+def create_remote_write(args):
+    """ return the RemoteWrite instance configured by --remote-write and the [remote_write] section of config.toml, None if disabled"""
+    options = dict(load_toml(args.farcaster_config_folder.joinpath("config.toml")).get("remote_write", {}))
+    if args.remote_write:
+        options["url"] = args.remote_write
+    if not options.get("url"):
+        return None
+    return RemoteWrite(**options)
+
+def create_daemon(config):
+    """ return the Daemon object of the daemon configured in config.toml"""
+    try:
+        return Daemon(*get_url_and_token(config["daemon_api"]))
+    except Exception as exp:
+        raise DaemonError("config value daemon_ip " + str(exp))
+
+def create_nodes(config, daemon=None):
+    """ return the (daemon, miner, markets) objects of the nodes configured in config.toml. A daemon shared by several
+    miners can be given"""
+
+    # Create the daemon Object instance
+    if daemon is None:
+        daemon = create_daemon(config)
+
+    # Create the miner Object instance
+    try:
+        miner = Miner(*get_url_and_token(config["miner_api"]))
+    except Exception as exp:
+        raise MinerError("config value miner_ip " + str(exp))
+
+    # Create the markets object instance
+    if config["markets_type"] == "boost":
+        if "boost_graphql" not in config.keys():
+            raise BoostError("config value boost_graphql not set")
+        if "boost_api" not in config.keys():
+            raise BoostError("config value boost_api not set")
+        try:
+            markets = Boost(*get_url_and_token(config["boost_api"]), config["boost_graphql"])
+        except Exception as exp:
+            raise BoostError("config value boost_api " + str(exp))
+    else:
+        try:
+            markets = Markets(*get_url_and_token(config["markets_api"]))
+        except Exception as exp:
+            raise MarketsError("config value markets_api " + str(exp))
+
+    return daemon, miner, markets
+
+def run(args, output, render_cache=None, remote_write=None, profiler=None, collectors=None):
     """Create all prerequisites object to collect"""
 
     # Load config file config.toml
@@ -1636,47 +3320,237 @@ def run(args, output):
     except Exception as exp:
         raise exp
 
+    # The connection settings of the capture are used to replay it
+    if RpcCapture.replaying:
+        config = {**config, "miners": [], **RpcCapture.config}
+    elif args.record and not RpcCapture.recording:
+        RpcCapture.start_recording(args.record, config)
+    Daemon.actor_cid_file = args.farcaster_config_folder.joinpath("actor_cids.json")
+
     # Verify that mandatory variable are in the config file
-    for variable in "miner_api", "markets_api", "daemon_api", "markets_type":
-        if variable not in config.keys():
-            logging.error(f"{variable} not found in {config_file}")
-            logging.info("Re-run the install.sh script or add it to the config file manually")
-            sys.exit(0)
-
-    with Metrics(output=output) as metrics:
-        # Create the daemon Object instance
-        try:
-            daemon = Daemon(*get_url_and_token(config["daemon_api"]))
-        except Exception as exp:
-            raise DaemonError("config value daemon_ip " + str(exp))
+    miners = miner_configs(config)
+    for miner_config in miners:
+        for variable in "miner_api", "markets_api", "daemon_api", "markets_type":
+            if variable not in miner_config.keys():
+                logging.error(f"{variable} not found in {config_file}")
+                logging.info("Re-run the install.sh script or add it to the config file manually")
+                sys.exit(0)
+
+    # Collectors of each miner : {miner index: Collectors}, kept between the scrapes in long-running mode
+    keep = collectors is not None
+    if collectors is None:
+        collectors = {}
+    for index in range(len(miners)):
+        collectors.setdefault(index, Collectors(keep, network=index == 0))
+
+    # Miners whose scrape failed in one-shot mode
+    failed = []
+
+    with Metrics(output=output, fmt=args.format, budgets=config.get("metrics_budget"), render_cache=render_cache, remote_write=remote_write, profiler=profiler) as metrics:
+        # Load addresses lookup config file to retrieve external wallet and vlookup
+        addresses_config = load_toml(args.farcaster_config_folder.joinpath("addresses.toml"))
+
+        if len(miners) == 1:
+            scrape_miner(args, miners[0], metrics, collectors[0], addresses_config)
+            return
 
-        # Create the miner Object instance
+        # Multi-miner : the daemon and its cached results (chain head, actor codes, wallets) are shared by the miners
         try:
-            miner = Miner(*get_url_and_token(config["miner_api"]))
+            daemon = create_daemon(config)
         except Exception as exp:
-            raise MinerError("config value miner_ip " + str(exp))
-
-        # Create the markets object instance
-        if config["markets_type"] == "boost":
-            if "boost_graphql" not in config.keys():
-                raise BoostError("config value boost_graphql not set")
-            if "boost_api" not in config.keys():
-                raise BoostError("config value boost_api not set")
+            if not keep:
+                raise
+            for index in range(len(miners)):
+                collectors[index].fail(metrics, exp)
+            return
+
+        # Each miner is collected in its own thread, the API calls of all the miners run on the shared event loop.
+        # The samples are added to the scrape in the order of the miners. The network samples (chain, daemon) are added
+        # once by the miner holding the network role, without miner_id label
+        import concurrent.futures
+
+        buffers = [MinerMetrics(metrics.fmt) for _ in miners]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(miners), thread_name_prefix="miner") as executor:
+            futures = [executor.submit(scrape_miner, args, miner_config, buffer, collectors[index], addresses_config, daemon, {"miner_id": None})
+                       for index, (miner_config, buffer) in enumerate(zip(miners, buffers))]
+        succeeded = []
+        for index, future in enumerate(futures):
             try:
-                markets = Boost(*get_url_and_token(config["boost_api"]), config["boost_graphql"])
+                succeeded.append(future.result())
             except Exception as exp:
-                raise BoostError("config value boost_api " + str(exp))
-        else:
+                logging.error(f"miner {index} failed : {exp}")
+                metrics.add_error(exp)
+                buffers[index] = None
+                succeeded.append(False)
+                failed.append(index)
+
+        # When the miner holding the network role failed, the role moves to the first miner that succeeded, which is
+        # collected again to add the network samples. The failed miner only reports its errors
+        holder = next(index for index in range(len(miners)) if collectors[index].network)
+        if not succeeded[holder] and any(succeeded):
+            index = succeeded.index(True)
+            logging.warning(f"miner {holder} failed, the network metrics are collected with miner {index}")
+            collectors[holder].set_network(False)
+            collectors[index].set_network(True)
+            if buffers[holder] is not None:
+                errors, buffers[holder] = buffers[holder].errors, MinerMetrics(metrics.fmt)
+                buffers[holder].errors = errors
+            buffer = MinerMetrics(metrics.fmt)
             try:
-                markets = Markets(*get_url_and_token(config["markets_api"]))
+                scrape_miner(args, miners[index], buffer, collectors[index], addresses_config, daemon, {"miner_id": None})
             except Exception as exp:
-                raise MarketsError("config value markets_api " + str(exp))
-
-        # Load addresses lookup config file to retrieve external wallet and vlookup
-        addresses_config = load_toml(args.farcaster_config_folder.joinpath("addresses.toml"))
+                logging.error(f"miner {index} failed : {exp}")
+                metrics.add_error(exp)
+                failed.append(index)
+            else:
+                buffers[index] = buffer
+
+        for buffer in buffers:
+            if buffer is not None:
+                buffer.add_to(metrics)
+
+    # The samples of the other miners are output, the exit code reports the failed miners as for a single miner
+    if failed:
+        raise Exception(f"{len(failed)} of {len(miners)} miners failed")
+
+def miner_configs(config):
+    """ return the configuration of each miner : the [[miners]] entries completed by the top level settings (daemon_api,
+    markets_type, collectors...), or the top level settings alone for a single miner"""
+    shared = {key: value for key, value in config.items() if key != "miners"}
+    for miner in config.get("miners", []):
+        if miner.get("daemon_api", shared.get("daemon_api")) != shared.get("daemon_api"):
+            raise Exception("miners : the miners share the daemon of the top level daemon_api, it can't be changed in [[miners]]")
+    return [{**shared, **miner} for miner in config.get("miners", [])] or [shared]
+
+def scrape_miner(args, config, metrics, collectors, addresses_config, daemon=None, labels=None):
+    """ collect the metrics of one miner and return True. In long-running mode, a failure exports the last samples of
+    the collectors and returns False"""
+    try:
+        collectors.configure(config.get("collectors"), args.collectors, args.exclude_collectors)
+        daemon, miner, markets = create_nodes(config, daemon)
 
         # execute the collector
-        collect(daemon, miner, markets, metrics, addresses_config)
+        collect(daemon, miner, markets, metrics, addresses_config, config, collectors, labels)
+    except Exception as exp:
+        # Long-running mode : the last samples of the collectors are exported with the error
+        if not collectors.keep:
+            raise
+        collectors.fail(metrics, exp)
+        return False
+    return True
+
+def write_file(file_name, data):
+    """ write data to file_name using a temporary file, so readers never see a partial file"""
+    tmp_file = f"{file_name}$$"
+    with open(tmp_file, "wb") as f:
+        f.write(data)
+    os.rename(tmp_file, file_name)
+
+def write_snapshot(args, snapshot):
+    """ write the snapshot to the textfile and its precompressed version FILE.gz with --gzip"""
+    write_file(args.file, snapshot.body)
+    if args.gzip:
+        write_file(f"{args.file}.gz", snapshot.gzip_body())
+
+def start_http_server(listen, exposition):
+    """ serve the exposition over HTTP on [ADDRESS:]PORT in a background thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    address, _, port = listen.rpartition(":")
+    handler = type("Handler", (MetricsHandler, BaseHTTPRequestHandler), {"exposition": exposition})
+    server = ThreadingHTTPServer((address, int(port)), handler)
+    threading.Thread(target=server.serve_forever, name="http", daemon=True).start()
+    logging.info(f"serving metrics on http://{address or '0.0.0.0'}:{port}/metrics")
+    return server
+
+def next_scrape_time(last_start, interval, offset=None, phase=0):
+    """ return the start time of the next scrape, interval seconds after the start of the last one. With an offset, the
+    scrape is delayed to offset + phase seconds after an epoch boundary : the head of the epoch is available and won't
+    change during the scrape"""
+    start = max(last_start + interval, time.time())
+    if offset is None:
+        return start
+    aligned = GENESIS_TIMESTAMP + offset + phase
+    return aligned + math.ceil((start - aligned) / EPOCH_DURATION) * EPOCH_DURATION
+
+def wait_for_head(args, timeout):
+    """ poll the chain head every second until the head of the current epoch is observed or timeout seconds elapsed.
+    A head more than one epoch behind is a syncing daemon, the scrape doesn't wait for it"""
+    try:
+        config = load_toml(args.farcaster_config_folder.joinpath("config.toml"))
+        watcher = ChainWatcher(*get_url_and_token(config["daemon_api"]))
+        epoch = int((time.time() - GENESIS_TIMESTAMP) / EPOCH_DURATION)
+        deadline = time.time() + timeout
+        while watcher.height() == epoch - 1 and time.time() < deadline:
+            time.sleep(1)
+    except Exception as exp:
+        logging.debug(f"cannot observe the chain head : {exp}")
+
+def serve(args):
+    """ long-running mode : scrape every interval, each scrape is rendered in its own Metrics registry and published atomically"""
+
+    exposition = Exposition(Metrics.content_types[args.format])
+    if args.listen:
+        start_http_server(args.listen, exposition)
+    try:
+        remote_write = create_remote_write(args)
+    except Exception as exp:
+        logging.error(exp)
+        sys.exit(1)
+
+    # Rendered lines of the series are kept from one scrape to the next one : {family: (hashes of the series, lines)}
+    render_cache = {}
+
+    # Collectors that are not due reuse the samples of their last refresh : {miner index: Collectors}
+    collectors = {}
+
+    # Each exporter draws its own phase in the jitter window, so exporters sharing a daemon don't scrape at the same instant
+    phase = random.uniform(0, args.jitter)
+    if args.epoch_offset is not None:
+        time.sleep(max(next_scrape_time(0, 0, args.epoch_offset, phase) - time.time(), 0))
+    else:
+        time.sleep(phase)
+
+    while True:
+        if args.wait_head:
+            wait_for_head(args, EPOCH_DURATION - args.epoch_offset)
+        start = time.time()
+        try:
+            run(args, output=exposition, render_cache=render_cache, remote_write=remote_write, collectors=collectors)
+        except (Exception, SystemExit) as exp:
+            if args.debug:
+                logging.error(traceback.format_exc())
+            else:
+                logging.error(exp)
+
+        # The textfile is written from the published snapshot
+        if args.file and args.file != "-" and exposition.get() is not None:
+            try:
+                write_snapshot(args, exposition.get())
+            except Exception as exp:
+                logging.error(f"cannot write {args.file} : {exp}")
+
+        time.sleep(max(next_scrape_time(start, args.interval, args.epoch_offset, phase) - time.time(), 0))
+
+def profile(args):
+    """ run one scrape under the profiler and write its report"""
+    profiler = Profiler(args.profile_mode)
+    exposition = Exposition(Metrics.content_types[args.format])
+    profiler.start()
+    try:
+        run(args, output=exposition, profiler=profiler)
+    except Exception as exp:
+        logging.error(exp)
+    finally:
+        profiler.stop()
+
+    if exposition.get() is not None:
+        if args.file and args.file != "-":
+            write_snapshot(args, exposition.get())
+        else:
+            sys.stdout.write(exposition.get().body.decode())
+    profiler.write(args.profile)
+    logging.info(f"profile written to {args.profile}.txt and {args.profile}.trace.json")
 
 def main():
     """ main function """
@@ -1688,34 +3562,97 @@ def main():
     parser.add_argument("-c", "--farcaster-config-folder", default=Path.home().joinpath(".lotus-exporter-farcaster"), type=Path, help="Specifiy farcaster config path usually ~/.lotus-exporter-farcaster")
     output = parser.add_mutually_exclusive_group()
     output.add_argument("--file", help="output metrics to file")
+    parser.add_argument("--listen", help="long-running mode : serve metrics over HTTP on [ADDRESS:]PORT")
+    parser.add_argument("--interval", type=float, help="long-running mode : scrape every INTERVAL seconds (default 60)")
+    parser.add_argument("--epoch-offset", type=float, help="long-running mode : start the scrapes OFFSET seconds after an epoch boundary (30s epochs), the interval is rounded up to whole epochs")
+    parser.add_argument("--jitter", type=float, default=0, help="long-running mode : delay the scrapes by a random phase between 0 and JITTER seconds drawn at startup, to spread exporters sharing a daemon")
+    parser.add_argument("--wait-head", action="store_true", help="long-running mode with --epoch-offset : before each scrape, wait for the head of the current epoch (polls ChainHead every second)")
+    parser.add_argument("--format", choices=Metrics.content_types.keys(), default="prometheus", help="exposition format (default prometheus)")
+    parser.add_argument("--gzip", action="store_true", help="also write a gzip compressed FILE.gz next to the metrics file")
+    parser.add_argument("--remote-write", help="push the samples to a Prometheus remote write URL (see [remote_write] in config.toml)")
+    parser.add_argument("--profile", metavar="PREFIX", help="profile one scrape and write the report PREFIX.txt and the trace PREFIX.trace.json")
+    parser.add_argument("--record", metavar="CAPTURE", help="record the API calls and responses of the scrape to the gzip file CAPTURE")
+    parser.add_argument("--replay", metavar="CAPTURE", help="scrape from the API calls recorded in CAPTURE instead of calling the nodes")
+    parser.add_argument("--replay-speed", type=float, default=1, help="multiply the recorded latencies by this factor when replaying, 0 disables them (default 1)")
+    parser.add_argument("--collectors", type=lambda names: names.split(","), help="run only these collectors, comma separated (see --list-collectors)")
+    parser.add_argument("--exclude-collectors", type=lambda names: names.split(","), help="skip these collectors, comma separated")
+    parser.add_argument("--list-collectors", action="store_true", help="list the collectors and their default refresh interval")
+    parser.add_argument("--profile-mode", choices=Profiler.modes, default="sampling", help="sampling (low overhead, default) or cprofile (every call and allocations)")
     args = parser.parse_args()
 
     # Configure the logging output
     logging.basicConfig(format='%(levelname)s: %(message)s', level=getattr(logging, args.log_level.upper(), None))
 
-    # In case output in a file, use a temporary file
+    if args.list_collectors:
+        for name, (_, interval, network) in COLLECTORS.items():
+            print(f"{name:<16} {interval:>5}s{'  network' if network else ''}")
+        return 0
+
+    try:
+        Collectors.resolve((args.collectors or []) + (args.exclude_collectors or []))
+    except Exception as exp:
+        parser.error(str(exp))
+
+    if args.gzip and (not args.file or args.file == "-"):
+        parser.error("--gzip requires --file")
+
+    # Record and replay a single scrape
+    if args.record or args.replay:
+        if args.listen or args.interval:
+            parser.error("--record and --replay can't be used in long-running mode")
+        if args.replay:
+            RpcCapture.start_replay(args.replay, args.replay_speed)
+
+    # Profile one scrape, the metrics are output as usual
+    if args.profile:
+        if args.listen or args.interval:
+            parser.error("--profile can't be used in long-running mode")
+        profile(args)
+        return 0
+
+    # Long-running mode
+    if args.listen or args.interval:
+        args.interval = args.interval or 60
+        if args.wait_head and args.epoch_offset is None:
+            parser.error("--wait-head requires --epoch-offset")
+        if args.epoch_offset is not None and not 0 <= args.epoch_offset + args.jitter < EPOCH_DURATION:
+            parser.error(f"--epoch-offset + --jitter must be between 0 and {EPOCH_DURATION} seconds")
+        serve(args)
+        return 0
+
+    # The pushed batches are sent before exiting
+    remote_write = None
+
+    # In case output in a file, render in memory and write it using a temporary file
     if args.file and args.file != "-":
-        tmp_file = f"{args.file}$$"
+        exposition = Exposition(Metrics.content_types[args.format])
         try:
-            with open(tmp_file, "w") as f:
-                run(args, output=f)
-            os.rename(tmp_file, args.file)
+            remote_write = create_remote_write(args)
+            run(args, output=exposition, remote_write=remote_write)
         except Exception as exp:
-            os.rename(tmp_file, args.file)
             logging.error(exp)
             sys.exit(1)
+        finally:
+            if exposition.get() is not None:
+                write_snapshot(args, exposition.get())
+            if remote_write is not None:
+                remote_write.close()
 
         return 0
 
     # If output to STDOUT
     try:
-        run(args, output=sys.stdout)
+        remote_write = create_remote_write(args)
+        run(args, output=sys.stdout, remote_write=remote_write)
     except Exception as exp:
         if args.debug:
             logging.error(traceback.format_exc())
         else:
             logging.error(exp)
         sys.exit(1)
+    finally:
+        if remote_write is not None:
+            remote_write.close()
 
 if __name__ == "__main__":
     main()